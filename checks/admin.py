@@ -6,7 +6,7 @@ from checks import models
 @admin.register(models.MerchantPoint)
 class MerchantPointAdmin(admin.ModelAdmin):
     list_display = (
-        'name', 'created_at', 'updated_at'
+        'name', 'retention_days', 'created_at', 'updated_at'
     )
     search_fields = ('name',)
 
@@ -16,7 +16,7 @@ class PrinterAdmin(admin.ModelAdmin):
     list_display = (
         'name', 'api_key', 'created_at', 'updated_at'
     )
-    list_filter = ('check_type',)
+    list_filter = ('check_type', 'output_format')
     search_fields = ('name',)
 
 
@@ -26,3 +26,10 @@ class CheckAdmin(admin.ModelAdmin):
         'pdf_file', 'created_at', 'updated_at'
     )
     list_filter = ('printer', 'check_type', 'status')
+
+
+@admin.register(models.RenderedFile)
+class RenderedFileAdmin(admin.ModelAdmin):
+    list_display = (
+        'digest', 'size', 'ref_count', 'created_at', 'last_used_at'
+    )
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ChecksConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'checks'
+
+    def ready(self):
+        from checks import signals  # noqa: F401
@@ -0,0 +1,12 @@
+from django.urls import path, include
+
+from checks import async_views
+
+# Hot endpoints served by async views under ASGI, the rest is the same as in checks.urls
+urlpatterns = [
+    path('media/<path:path>/', async_views.download, name='media'),
+    path('checks/', async_views.checks, name='check-list'),
+    path('checks/for-print/<str:api_key>/', async_views.for_print, name='check-for-print'),
+    path('checks/stream/<str:api_key>/', async_views.stream, name='check-stream'),
+    path('', include('checks.urls'))
+]
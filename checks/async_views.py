@@ -0,0 +1,154 @@
+import json
+import logging
+from functools import wraps
+
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.http import HttpResponseNotAllowed, JsonResponse
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+
+from checks import models, serializers
+from checks.dispatch import dispatch_order
+from checks.events import asubscribe_printer
+from checks.pagination import ForPrintPagination
+from checks.views import CheckViewSet, error_event, event_stream, get_printer_id, rendered_event, serve_file
+
+log = logging.getLogger(__name__)
+
+check_list = CheckViewSet.as_view({'get': 'list'})
+
+
+def api_errors(view):
+    """Turns API exceptions of an async view into JSON responses as DRF views do"""
+
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            return await view(request, *args, **kwargs)
+        except APIException as err:
+            return JsonResponse({'detail': err.detail}, status=err.status_code, encoder=JSONEncoder)
+
+    return wrapper
+
+
+async def checks(request):
+    """Checks list, orders are created by the async view and the rest is left to CheckViewSet"""
+    if request.method == 'POST':
+        return await create(request)
+    return await sync_to_async(check_list)(request)
+
+
+# DRF views are exempt from CSRF checks as well
+checks.csrf_exempt = True
+
+
+async def create(request):
+    """Create checks of the order with one INSERT, rendering is dispatched after it"""
+    try:
+        data = json.loads(request.body)
+    except ValueError as err:
+        return JsonResponse({'detail': f'JSON parse error - {err}'}, status=400)
+    serializer = serializers.CheckItemSerializer(data=data)
+    # validation reads the routing table, which is rebuilt from the database when stale
+    if not await sync_to_async(serializer.is_valid)():
+        return JsonResponse(serializer.errors, status=400, encoder=JSONEncoder)
+    checks = serializer.build_checks(serializer.validated_data)
+    await models.Check.objects.abulk_create(checks)
+    # the representation of the created check, as CheckViewSet responds
+    data = serializers.CheckItemSerializer(checks[0], context={'request': request}).data['order']
+    await sync_to_async(dispatch_order)(data['uuid'])
+    data['checks'] = serializers.CheckListSerializer(checks, many=True).data
+    return JsonResponse(data, status=201, encoder=JSONEncoder)
+
+
+@api_errors
+async def for_print(request, api_key):
+    """Rendered checks of the printer, long-poll requests wait for them without holding a thread"""
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    printer_id = await sync_to_async(get_printer_id)(api_key)
+    api_request = Request(request)
+    wait = CheckViewSet.get_wait(api_request)
+    paginator = ForPrintPagination()
+    paginate = sync_to_async(paginator.paginate_queryset)
+    queryset = models.Check.objects.filter(printer_id=printer_id, status='rendered')
+    if wait:
+        try:
+            # Subscribe before the query so a check rendered in between is not missed
+            async with asubscribe_printer(printer_id) as subscription:
+                page = await paginate(queryset, api_request)
+                if not page:
+                    # do not hold a database connection while waiting
+                    await sync_to_async(release_connection)()
+                if not page and await subscription.get(timeout=wait) is not None:
+                    page = await paginate(queryset, api_request)
+        except redis.RedisError as err:
+            # printers poll without waiting while events are down
+            log.error(err)
+            page = await paginate(queryset, api_request)
+    else:
+        page = await paginate(queryset, api_request)
+    data = serializers.CheckListSerializer(page, many=True, context={'request': api_request}).data
+    return JsonResponse(paginator.get_paginated_response(data).data, encoder=JSONEncoder)
+
+
+async def stream(request, api_key):
+    """Server-sent events stream of checks rendered for the printer, clients wait without holding a thread"""
+    printer_id = await sync_to_async(get_printer_id)(api_key)
+
+    async def events():
+        try:
+            async with asubscribe_printer(printer_id) as subscription:
+                yield ': connected\n\n'
+                while True:
+                    message = await subscription.get(timeout=settings.CHECKS_STREAM_KEEPALIVE)
+                    if message is None:
+                        yield ': keepalive\n\n'
+                        continue
+                    event = await sync_to_async(get_event)(request, message['id'])
+                    if event is not None:
+                        yield event
+        except redis.RedisError as err:
+            log.error(err)
+            yield error_event('Events are unavailable')
+
+    return event_stream(events())
+
+
+def get_event(request, check_id):
+    """Rendered event of the check, the connection is not held between events of the stream"""
+    try:
+        return rendered_event(request, check_id)
+    finally:
+        release_connection()
+
+
+def release_connection():
+    """Closes the database connection of the thread unless it is in a transaction, queries reopen it"""
+    if not connection.in_atomic_block:
+        connection.close()
+
+
+async def download(request, path):
+    """Media files streamed from the storage without holding a thread"""
+    return await sync_to_async(serve_file)(request, path, aread_range)
+
+
+async def aread_range(path, start, length, chunk_size=1024 * 1024):
+    # every block read is a hop to a thread, so blocks are large
+    f = await sync_to_async(default_storage.open, thread_sensitive=False)(path)
+    try:
+        await sync_to_async(f.seek, thread_sensitive=False)(start)
+        while length > 0:
+            chunk = await sync_to_async(f.read, thread_sensitive=False)(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await sync_to_async(f.close, thread_sensitive=False)()
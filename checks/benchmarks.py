@@ -0,0 +1,186 @@
+import math
+import random
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.db import connections
+
+from checks.renderers import PAGE_BREAK, SimpleRenderer, TextExtractor
+
+MENU = (
+    ('pizza', 109),
+    ('sauce', 15),
+    ('lemonade', 50),
+    ('burger', 89),
+    ('fries', 35),
+    ('salad', 64),
+    ('coffee', 25),
+    ('cake', 45),
+)
+
+
+class StubRendererHandler(BaseHTTPRequestHandler):
+    # keep-alive, so the renderer client reuses its pooled connections
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        message = BytesParser(policy=HTTP).parsebytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode('latin-1') + b'\r\n\r\n' + body
+        )
+        html = next(message.iter_parts()).get_payload(decode=True).decode('utf-8')
+        time.sleep(self.server.get_delay())
+        pdf = self.server.to_pdf(html)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(len(pdf)))
+        self.end_headers()
+        self.wfile.write(pdf)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubRenderer(ThreadingHTTPServer):
+    """
+    Local stand-in for the wkhtmltopdf HTTP service. Answers with a PDF of the text
+    of the uploaded HTML after latency seconds plus a seeded random jitter,
+    page breaks start new pages, so batches are split as with the real service
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.05, jitter=0.0, seed=0, address=('127.0.0.1', 0)):
+        super().__init__(address, StubRendererHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.renderer = SimpleRenderer()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def get_delay(self):
+        with self.lock:
+            self.requests += 1
+            return self.latency + self.random.uniform(0, self.jitter)
+
+    def to_pdf(self, html):
+        pages = []
+        for part in html.split(PAGE_BREAK):
+            extractor = TextExtractor()
+            extractor.feed(part)
+            pages.append([line for line in extractor.lines if line])
+        return self.renderer.build_pdf(pages)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+class OrderGenerator:
+    """Seeded generator of orders of the merchant point with random items of the menu"""
+
+    def __init__(self, merchant_point, seed=0, max_items=5):
+        self.merchant_point = merchant_point
+        self.random = random.Random(seed)
+        self.max_items = max_items
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        dishes = self.random.sample(MENU, self.random.randint(1, self.max_items))
+        items = [{'name': name, 'price': price, 'count': self.random.randint(1, 3)} for name, price in dishes]
+        return {
+            'merchant_point': self.merchant_point,
+            'total_price': sum(item['price'] * item['count'] for item in items),
+            'items': items
+        }
+
+
+def run_load(call, count, concurrency):
+    """
+    Calls call(number) count times from concurrency threads.
+    Returns latencies of the successful calls, errors and elapsed seconds
+    """
+    numbers = iter(range(count))
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def worker():
+        try:
+            while True:
+                with lock:
+                    number = next(numbers, None)
+                if number is None:
+                    return
+                started_at = time.perf_counter()
+                try:
+                    call(number)
+                except Exception as err:
+                    errors.append(err)
+                    continue
+                latencies.append(time.perf_counter() - started_at)
+        finally:
+            # the benchmark database is dropped at the end, threads must not keep connections to it
+            connections.close_all()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.perf_counter() - started_at
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[max(math.ceil(len(values) * q / 100) - 1, 0)]
+
+
+def summarize(latencies, elapsed, errors=()):
+    """Result of a scenario, latencies are in milliseconds"""
+    latencies = sorted(latency * 1000 for latency in latencies)
+    result = {
+        'count': len(latencies),
+        'errors': len(errors),
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 1) if elapsed else None,
+    }
+    for q in (50, 95, 99, 100):
+        value = percentile(latencies, q)
+        result['max' if q == 100 else f'p{q}'] = None if value is None else round(value, 2)
+    if errors:
+        result['error'] = repr(errors[0])
+    return result
+
+
+def compare_results(baseline, results, threshold, metric='p95'):
+    """Returns regressions of scenarios whose metric grew by more than threshold percent over the baseline"""
+    regressions = []
+    for name, result in results['scenarios'].items():
+        base = baseline['scenarios'].get(name, {}).get(metric)
+        if not base or result.get(metric) is None:
+            continue
+        change = (result[metric] - base) / base * 100
+        if change > threshold:
+            regressions.append(f'{name}: {metric} {base} ms -> {result[metric]} ms (+{change:.1f}%)')
+    return regressions
@@ -0,0 +1,336 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict, namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from checks import models
+
+log = logging.getLogger(__name__)
+
+MISSING = object()
+
+# Cached instead of a printer id for unknown api keys, printer ids start with 1
+NOT_FOUND = 0
+
+Route = namedtuple('Route', ['address', 'printers'])
+RoutePrinter = namedtuple('RoutePrinter', ['id', 'check_type', 'output_format'])
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with TTL"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns cached value or MISSING"""
+        with self.lock:
+            item = self.data.get(key, MISSING)
+            if item is MISSING:
+                return MISSING
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self.data[key]
+                return MISSING
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class PrinterKeyCache:
+    """
+    Resolves printer api key to printer id.
+    Lookups go through the local LRU, then the optional shared Django cache
+    and only then the database. Invalidation clears the LRU of the saving process only,
+    so LRUs of other processes keep keys for local_ttl seconds. Unknown keys are cached
+    for negative_ttl seconds, so a new key is not rejected for long
+    """
+
+    def __init__(self, maxsize, ttl, alias=None, local_ttl=None, negative_ttl=None):
+        self.local = LRUCache(maxsize=maxsize, ttl=ttl if local_ttl is None else local_ttl)
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.alias = alias
+
+    @property
+    def shared(self):
+        return caches[self.alias] if self.alias else None
+
+    @staticmethod
+    def make_key(api_key):
+        return f'checks:printer-key:{api_key}'
+
+    def resolve(self, api_key):
+        """Returns printer id or None if there is no printer with the api key"""
+        printer_id = self.local.get(api_key)
+        if printer_id is MISSING and self.shared is not None:
+            printer_id = self.shared.get(self.make_key(api_key), MISSING)
+            if printer_id is not MISSING:
+                self.set_local(api_key, printer_id)
+        if printer_id is MISSING:
+            printer_id = models.Printer.objects.filter(
+                api_key=api_key
+            ).values_list('pk', flat=True).first() or NOT_FOUND
+            self.set_local(api_key, printer_id)
+            if self.shared is not None:
+                ttl = self.negative_ttl if printer_id == NOT_FOUND else self.ttl
+                self.shared.set(self.make_key(api_key), printer_id, ttl)
+        return printer_id or None
+
+    def set_local(self, api_key, printer_id):
+        if printer_id == NOT_FOUND:
+            self.local.set(api_key, printer_id, min(self.local.ttl, self.negative_ttl))
+        else:
+            self.local.set(api_key, printer_id)
+
+    def invalidate(self, api_key):
+        self.local.delete(api_key)
+        if self.shared is not None:
+            self.shared.delete(self.make_key(api_key))
+
+    def clear(self):
+        self.local.clear()
+
+
+class RoutingTable:
+    """
+    Versioned merchant point -> printers routing table.
+    The table is kept in process and rebuilt with two queries when the version
+    in the optional shared Django cache changes, so routing an order needs no topology queries.
+    Tables also expire after ttl seconds, without a shared cache that is how
+    changes saved by other processes are picked up
+    """
+    version_key = 'checks:routing:version'
+
+    def __init__(self, alias, ttl):
+        self.alias = alias
+        self.ttl = ttl
+        self.version = None
+        self.expires_at = 0
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, merchant_point):
+        """Returns route of the merchant point or None"""
+        try:
+            merchant_point = int(merchant_point)
+        except (TypeError, ValueError):
+            return None
+        version = self.get_version()
+        if version != self.version or self.expires_at <= time.monotonic():
+            with self.lock:
+                if version != self.version or self.expires_at <= time.monotonic():
+                    self.rebuild(version)
+        return self.routes.get(merchant_point)
+
+    def get_version(self):
+        if self.alias is None:
+            return None
+        return self.cache.get_or_set(self.version_key, lambda: int(time.time() * 1000), None)
+
+    def rebuild(self, version):
+        printers = defaultdict(list)
+        for printer_id, check_type, output_format, merchant_point_id in models.Printer.objects.order_by(
+                'pk').values_list('pk', 'check_type', 'output_format', 'merchant_point_id'):
+            printers[merchant_point_id].append(RoutePrinter(printer_id, check_type, output_format))
+        self.routes = {
+            merchant_point_id: Route(address, printers[merchant_point_id])
+            for merchant_point_id, address in models.MerchantPoint.objects.values_list('pk', 'address')
+        }
+        self.version = version
+        self.expires_at = time.monotonic() + self.ttl
+
+    def invalidate(self):
+        """Bump the version so every process rebuilds its table"""
+        self.expires_at = 0
+        if self.alias is None:
+            return
+        try:
+            self.cache.incr(self.version_key)
+        except ValueError:
+            self.cache.add(self.version_key, int(time.time() * 1000), None)
+
+
+class RenderCache:
+    """
+    Content-addressed store of rendered files.
+    Files are keyed by the digest of the rendered HTML with the template version
+    and renderer, every check using a file holds a reference to it.
+    Only unreferenced files are evicted, least recently used first.
+    Hits and misses are counted in the Django cache of alias, they are not counted without one
+    """
+    prefix = 'cas'
+    hits_key = 'checks:render-cache:hits'
+    misses_key = 'checks:render-cache:misses'
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def make_digest(check, address, output_format):
+        """
+        Digest of what the rendered check shows: its type, the address, items and total of the order
+        with the template version and the renderer. Checks of different orders with the same items share it
+        """
+        if output_format == 'escpos':
+            renderer = (
+                f'escpos:{settings.CHECKS_ESCPOS_WIDTH}:{settings.CHECKS_ESCPOS_ENCODING}:'
+                f'{settings.CHECKS_ESCPOS_CODEPAGE}'
+            )
+        else:
+            renderer = settings.CHECKS_RENDERER
+        order = check.order
+        key = json.dumps([
+            settings.CHECKS_TEMPLATE_VERSION,
+            renderer,
+            check.check_type,
+            address,
+            [[item['name'], item['count'], item['price']] for item in order['items']],
+            order['total_price']
+        ])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def make_name(self, digest, extension='pdf'):
+        return f'{self.prefix}/{digest[:2]}/{digest}.{extension}'
+
+    def parse_digest(self, name):
+        """Returns digest of a cached file name or None for files outside the cache"""
+        if not name or not name.startswith(f'{self.prefix}/'):
+            return None
+        return name.rsplit('/', 1)[-1].split('.', 1)[0]
+
+    def acquire(self, digest, count=1):
+        """Returns name of the cached file with count new references to it or None"""
+        updated = models.RenderedFile.objects.filter(digest=digest).update(
+            ref_count=F('ref_count') + count, last_used_at=timezone.now()
+        )
+        if not updated:
+            self.count(self.misses_key)
+            return None
+        self.count(self.hits_key)
+        return models.RenderedFile.objects.values_list('file', flat=True).get(digest=digest)
+
+    def store(self, digest, name, size, count=1):
+        """Register a rendered file with count references to it"""
+        try:
+            with transaction.atomic():
+                models.RenderedFile.objects.create(digest=digest, file=name, size=size, ref_count=count)
+        except IntegrityError:
+            # rendered concurrently by another worker into the same name
+            models.RenderedFile.objects.filter(digest=digest).update(
+                ref_count=F('ref_count') + count, last_used_at=timezone.now()
+            )
+
+    def release(self, names):
+        """Drop references of deleted checks to cached files"""
+        digests = {}
+        for name in names:
+            digest = self.parse_digest(name)
+            if digest:
+                digests[digest] = digests.get(digest, 0) + 1
+        for digest, count in digests.items():
+            models.RenderedFile.objects.filter(digest=digest, ref_count__gte=count).update(
+                ref_count=F('ref_count') - count
+            )
+
+    def evict(self, max_size, batch_size=100):
+        """Delete least recently used unreferenced files until the store fits in max_size bytes"""
+        total = models.RenderedFile.objects.aggregate(total=Sum('size'))['total'] or 0
+        evicted = 0
+        while total > max_size:
+            with transaction.atomic():
+                files = list(
+                    models.RenderedFile.objects.select_for_update(skip_locked=True).filter(
+                        ref_count=0
+                    ).order_by('last_used_at')[:batch_size]
+                )
+                if not files:
+                    break
+                for rendered_file in files:
+                    if total <= max_size:
+                        break
+                    rendered_file.delete()
+                    default_storage.delete(rendered_file.file.name)
+                    total -= rendered_file.size
+                    evicted += 1
+        if evicted:
+            log.info(f'Evicted {evicted} rendered files')
+        return evicted
+
+    def count(self, key):
+        if self.alias is None:
+            return
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.add(key, 0, None)
+            self.cache.incr(key)
+
+    def get_stats(self):
+        if self.alias is None:
+            hits = misses = hit_rate = None
+        else:
+            hits = self.cache.get(self.hits_key, 0)
+            misses = self.cache.get(self.misses_key, 0)
+            hit_rate = hits / (hits + misses) if hits + misses else 0
+        stats = models.RenderedFile.objects.aggregate(total_size=Sum('size'), references=Sum('ref_count'))
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hit_rate,
+            'files': models.RenderedFile.objects.count(),
+            'size': stats['total_size'] or 0,
+            'references': stats['references'] or 0
+        }
+
+    def reset_stats(self):
+        if self.alias is None:
+            return
+        self.cache.delete_many([self.hits_key, self.misses_key])
+
+
+printer_keys = PrinterKeyCache(
+    maxsize=settings.CHECKS_PRINTER_CACHE_SIZE,
+    ttl=settings.CHECKS_PRINTER_CACHE_TTL,
+    alias=settings.CHECKS_PRINTER_CACHE_ALIAS,
+    local_ttl=settings.CHECKS_PRINTER_CACHE_LOCAL_TTL,
+    negative_ttl=settings.CHECKS_PRINTER_CACHE_NEGATIVE_TTL
+)
+
+routing = RoutingTable(alias=settings.CHECKS_ROUTING_CACHE_ALIAS, ttl=settings.CHECKS_ROUTING_CACHE_TTL)
+
+render_cache = RenderCache(alias=settings.CHECKS_RENDER_CACHE_ALIAS)
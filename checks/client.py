@@ -0,0 +1,132 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised without calling the service while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing service for reset_timeout seconds
+    after threshold failures in a row, then lets a trial call through
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def before_call(self):
+        if self.is_open:
+            raise CircuitOpenError('Circuit breaker is open')
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if not self.is_open:
+                    log.warning(f'Circuit breaker is open after {self.failures} failures')
+                self.opened_at = time.monotonic()
+
+
+class RendererClient:
+    """HTTP client for the wkhtmltopdf service with keep-alive connection pool"""
+
+    def __init__(self, url, connect_timeout, read_timeout, pool_size,
+                 retries, backoff, backoff_max, breaker):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker = breaker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_backoff(self, attempt):
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def post(self, **kwargs):
+        """POST to the service, retrying connection errors, timeouts and 5xx responses"""
+        for attempt in range(self.retries + 1):
+            self.breaker.before_call()
+            try:
+                resp = self.session.post(url=self.url, timeout=self.timeout, **kwargs)
+                resp.raise_for_status()
+            except requests.HTTPError as err:
+                err.response.close()
+                if err.response.status_code < 500:
+                    raise
+                self.breaker.record_failure()
+                if attempt == self.retries:
+                    raise
+                log.warning(err)
+            except requests.RequestException as err:
+                self.breaker.record_failure()
+                if attempt == self.retries:
+                    raise
+                log.warning(err)
+            else:
+                self.breaker.record_success()
+                return resp
+            time.sleep(self.get_backoff(attempt))
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_pid = None
+
+
+def get_client():
+    """Returns renderer client of the current process"""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = RendererClient(
+            url=settings.WKHTMLTOPDF_URL,
+            connect_timeout=settings.WKHTMLTOPDF_CONNECT_TIMEOUT,
+            read_timeout=settings.WKHTMLTOPDF_READ_TIMEOUT,
+            pool_size=settings.WKHTMLTOPDF_POOL_SIZE,
+            retries=settings.WKHTMLTOPDF_RETRIES,
+            backoff=settings.WKHTMLTOPDF_BACKOFF,
+            backoff_max=settings.WKHTMLTOPDF_BACKOFF_MAX,
+            breaker=CircuitBreaker(
+                threshold=settings.WKHTMLTOPDF_CIRCUIT_THRESHOLD,
+                reset_timeout=settings.WKHTMLTOPDF_CIRCUIT_RESET_TIMEOUT
+            )
+        )
+        _client_pid = os.getpid()
+    return _client
+
+
+def reset_client(**kwargs):
+    """Drop the client, connections must not be shared with forked worker processes"""
+    global _client
+    if _client is not None and _client_pid == os.getpid():
+        _client.close()
+    _client = None
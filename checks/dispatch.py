@@ -0,0 +1,121 @@
+import atexit
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+
+from checks.celery import app
+
+log = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    """
+    Collects orders committed in the process within a short window
+    and sends them as create_orders tasks over one broker connection.
+    A batch failing to send goes back to pending up to retries times with growing delays,
+    orders given up on are left to the sweeper
+    """
+
+    def __init__(self, window, max_orders, retries=3, retry_delay=1.0):
+        self.window = window
+        self.max_orders = max_orders
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.pending = []
+        self.timer = None
+
+    def add(self, order_uuids):
+        with self.lock:
+            self.pending.extend(order_uuids)
+            if self.window > 0 and len(self.pending) < self.max_orders:
+                self.schedule(self.window)
+                return
+            batch = self.take()
+        self.send(batch)
+
+    def schedule(self, delay):
+        if self.timer is None:
+            self.timer = threading.Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def take(self):
+        batch, self.pending = self.pending, []
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return batch
+
+    def flush(self):
+        with self.lock:
+            batch = self.take()
+        if not batch:
+            return
+        try:
+            self.send(batch)
+        except Exception as err:
+            with self.lock:
+                self.failures += 1
+                if self.failures <= self.retries:
+                    log.warning(f'Failed to dispatch {len(batch)} orders, retry {self.failures}: {err}')
+                    # orders added meanwhile are sent together with the batch
+                    self.pending[:0] = batch
+                    self.schedule(self.retry_delay * 2 ** (self.failures - 1))
+                    return
+                self.failures = 0
+            # nothing else would report errors of the timer thread
+            log.exception(f'Failed to dispatch {len(batch)} orders: {err}')
+        else:
+            self.failures = 0
+
+    def send(self, order_uuids):
+        from checks.tasks import create_orders
+
+        with app.producer_or_acquire() as producer:
+            for i in range(0, len(order_uuids), self.max_orders):
+                create_orders.apply_async((order_uuids[i:i + self.max_orders],), producer=producer)
+
+
+_dispatcher = None
+_dispatcher_pid = None
+
+
+def get_dispatcher():
+    """Returns dispatcher of the current process, timers are not inherited by forked processes"""
+    global _dispatcher, _dispatcher_pid
+    if _dispatcher is None or _dispatcher_pid != os.getpid():
+        _dispatcher = Dispatcher(
+            window=settings.CHECKS_DISPATCH_WINDOW,
+            max_orders=settings.CHECKS_DISPATCH_MAX_ORDERS,
+            retries=settings.CHECKS_DISPATCH_RETRIES,
+            retry_delay=settings.CHECKS_DISPATCH_RETRY_DELAY
+        )
+        _dispatcher_pid = os.getpid()
+    return _dispatcher
+
+
+@atexit.register
+def reset_dispatcher():
+    """Send orders still waiting for their window"""
+    global _dispatcher
+    if _dispatcher is not None and _dispatcher_pid == os.getpid():
+        _dispatcher.flush()
+    _dispatcher = None
+
+
+@receiver(setting_changed)
+def reset_dispatcher_settings(setting, **kwargs):
+    if setting.startswith('CHECKS_DISPATCH_'):
+        reset_dispatcher()
+
+
+def dispatch_order(order_uuid):
+    """Send rendering of the order once its checks are committed"""
+    transaction.on_commit(lambda: get_dispatcher().add([order_uuid]))
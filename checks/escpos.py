@@ -0,0 +1,58 @@
+from django.conf import settings
+
+ESC = b'\x1b'
+GS = b'\x1d'
+
+INIT = ESC + b'@'
+ALIGN_LEFT = ESC + b'a\x00'
+ALIGN_CENTER = ESC + b'a\x01'
+BOLD_ON = ESC + b'E\x01'
+BOLD_OFF = ESC + b'E\x00'
+DOUBLE_SIZE = GS + b'!\x11'
+NORMAL_SIZE = GS + b'!\x00'
+FEED_AND_CUT = GS + b'V\x42\x03'
+
+
+class EscPosBuilder:
+    """Builds ESC/POS byte stream for thermal receipt printers"""
+
+    def __init__(self, width, encoding, codepage):
+        self.width = width
+        self.encoding = encoding
+        self.data = bytearray(INIT + ESC + b't' + bytes([codepage]))
+
+    def raw(self, command):
+        self.data += command
+        return self
+
+    def text(self, text=''):
+        self.data += text.encode(self.encoding, 'replace') + b'\n'
+        return self
+
+    def columns(self, left, right):
+        """Line with left text and right aligned text, left text is cut to fit"""
+        left = left[:max(self.width - len(right) - 1, 0)]
+        return self.text(f'{left}{right.rjust(self.width - len(left))}')
+
+    def rule(self):
+        return self.text('-' * self.width)
+
+    def build(self):
+        return bytes(self.data + b'\n' + FEED_AND_CUT)
+
+
+def render_escpos(check, address):
+    """Returns ESC/POS receipt of the check, no HTML or PDF involved"""
+    order = check.order
+    builder = EscPosBuilder(
+        width=settings.CHECKS_ESCPOS_WIDTH,
+        encoding=settings.CHECKS_ESCPOS_ENCODING,
+        codepage=settings.CHECKS_ESCPOS_CODEPAGE
+    )
+    builder.raw(ALIGN_CENTER + DOUBLE_SIZE).text(check.check_type.upper()).raw(NORMAL_SIZE)
+    # checks of different orders with the same items share one rendered file
+    builder.text(address).raw(ALIGN_LEFT).rule()
+    for item in order['items']:
+        builder.columns(f"{item['name']} x{item['count']}", str(item['price']))
+    builder.rule().raw(BOLD_ON).columns('TOTAL', str(order['total_price'])).raw(BOLD_OFF)
+    return builder.build()
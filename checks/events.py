@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+
+import redis
+import redis.asyncio
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+log = logging.getLogger(__name__)
+
+
+class RedisEvents:
+    """Events backend over Redis pub/sub"""
+
+    def __init__(self, url):
+        self.url = url
+        self.client = redis.Redis.from_url(url)
+        self.async_clients = {}
+
+    def publish(self, channel, message):
+        self.client.publish(channel, json.dumps(message))
+
+    @contextmanager
+    def subscribe(self, channel):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        try:
+            yield RedisSubscription(pubsub)
+        finally:
+            pubsub.close()
+
+    @asynccontextmanager
+    async def asubscribe(self, channel):
+        # connections of an asyncio client belong to the event loop they were made in
+        loop = asyncio.get_running_loop()
+        client = self.async_clients.get(loop)
+        if client is None:
+            client = self.async_clients[loop] = redis.asyncio.Redis.from_url(self.url)
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(channel)
+        try:
+            yield AsyncRedisSubscription(pubsub)
+        finally:
+            await pubsub.reset()
+
+
+class RedisSubscription:
+    """Subscription to a Redis channel"""
+
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    def get(self, timeout):
+        """Returns the next message or None if nothing was published within timeout"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            message = self.pubsub.get_message(timeout=remaining)
+            if message and message['type'] == 'message':
+                return json.loads(message['data'])
+
+
+class AsyncRedisSubscription:
+    """Subscription to a Redis channel for asyncio code"""
+
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    async def get(self, timeout):
+        """Returns the next message or None if nothing was published within timeout"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            message = await self.pubsub.get_message(timeout=remaining)
+            if message and message['type'] == 'message':
+                return json.loads(message['data'])
+
+
+class InMemoryEvents:
+    """Events backend within the current process, used for tests and local runs"""
+
+    def __init__(self, url=None):
+        self.subscribers = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = list(self.subscribers[channel])
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+    @contextmanager
+    def subscribe(self, channel):
+        subscriber = queue.Queue()
+        with self.lock:
+            self.subscribers[channel].add(subscriber)
+        try:
+            yield InMemorySubscription(subscriber)
+        finally:
+            with self.lock:
+                self.subscribers[channel].discard(subscriber)
+
+    @asynccontextmanager
+    async def asubscribe(self, channel):
+        subscriber = AsyncQueue(asyncio.get_running_loop())
+        with self.lock:
+            self.subscribers[channel].add(subscriber)
+        try:
+            yield AsyncInMemorySubscription(subscriber.queue)
+        finally:
+            with self.lock:
+                self.subscribers[channel].discard(subscriber)
+
+
+class AsyncQueue:
+    """Queue of an event loop taking messages published from any thread"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put(self, message):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+
+
+class InMemorySubscription:
+    """Subscription to an in-memory channel"""
+
+    def __init__(self, subscriber):
+        self.subscriber = subscriber
+
+    def get(self, timeout):
+        """Returns the next message or None if nothing was published within timeout"""
+        try:
+            return self.subscriber.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class AsyncInMemorySubscription:
+    """Subscription to an in-memory channel for asyncio code"""
+
+    def __init__(self, subscriber):
+        self.subscriber = subscriber
+
+    async def get(self, timeout):
+        """Returns the next message or None if nothing was published within timeout"""
+        try:
+            return await asyncio.wait_for(self.subscriber.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+@lru_cache(maxsize=None)
+def get_events():
+    """Returns events backend configured in settings"""
+    backend = import_string(settings.CHECKS_EVENTS_BACKEND)
+    return backend(settings.CHECKS_EVENTS_URL)
+
+
+@receiver(setting_changed)
+def reset_events(setting, **kwargs):
+    if setting in ('CHECKS_EVENTS_BACKEND', 'CHECKS_EVENTS_URL'):
+        get_events.cache_clear()
+
+
+def printer_channel(printer_id):
+    return f'checks:printer:{printer_id}'
+
+
+def publish_rendered(check):
+    """Notify the printer of the check that the check is ready for print"""
+    try:
+        get_events().publish(printer_channel(check.printer_id), {'id': check.pk})
+    except redis.RedisError as err:
+        log.error(err)
+
+
+def subscribe_printer(printer_id):
+    """Subscribe to checks rendered for the printer"""
+    return get_events().subscribe(printer_channel(printer_id))
+
+
+def asubscribe_printer(printer_id):
+    """Subscribe to checks rendered for the printer from asyncio code"""
+    return get_events().asubscribe(printer_channel(printer_id))
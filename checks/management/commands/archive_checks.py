@@ -0,0 +1,23 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from checks.retention import archive_printed_checks
+
+
+class Command(BaseCommand):
+    help = 'Archive printed checks older than the retention policy of their merchant point'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--merchant-point',
+            type=int,
+            action='append',
+            dest='merchant_points',
+            help='Id of a merchant point, may be repeated, all points by default'
+        )
+        parser.add_argument('--batch-size', type=int, help='Checks per archive file and delete')
+
+    def handle(self, *args, **options):
+        archived = archive_printed_checks(options['merchant_points'], options['batch_size'])
+        self.stdout.write(json.dumps(archived, indent=2))
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+from django.utils.module_loading import import_string
+
+SAMPLE_CHECK = {
+    'check_type': 'kitchen',
+    'order': {
+        'uuid': 'd93645e9-d2d8-48fa-8352-d0dc7736c991',
+        'merchant_point': 1,
+        'total_price': 174,
+        'items': [
+            {'name': 'pizza', 'price': 109, 'count': 1},
+            {'name': 'sauce', 'price': 15, 'count': 1},
+            {'name': 'lemonade', 'price': 50, 'count': 1}
+        ]
+    }
+}
+
+
+class Command(BaseCommand):
+    help = 'Measure renders per second of renderer backends and batch sizes on the check.html template'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100, help='Renders per backend')
+        parser.add_argument(
+            '--renderer',
+            action='append',
+            dest='renderers',
+            help='Dotted path of a renderer backend, may be repeated'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            action='append',
+            dest='batch_sizes',
+            help='Checks per render_many call, may be repeated'
+        )
+
+    def handle(self, *args, **options):
+        html = render_to_string(
+            template_name='check.html',
+            context={'check': SAMPLE_CHECK, 'address': 'New York, Nine Street, 1'}
+        )
+        renderers = options['renderers'] or [
+            'checks.renderers.LocalRenderer',
+            'checks.renderers.PooledRenderer'
+        ]
+        count = options['count']
+        batch_sizes = options['batch_sizes'] or [1]
+        for path in renderers:
+            renderer = import_string(path)()
+            renderer.start()
+            try:
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    # the first render of a pool pays for its warm-up
+                    renderer.render(html, os.path.join(tmp_dir, 'check.pdf'))
+                    for batch_size in batch_sizes:
+                        documents = [
+                            (html, os.path.join(tmp_dir, f'check-{i}.pdf')) for i in range(batch_size)
+                        ]
+                        batches = max(count // batch_size, 1)
+                        started_at = time.perf_counter()
+                        for _ in range(batches):
+                            renderer.render_many(documents)
+                        elapsed = time.perf_counter() - started_at
+                        rendered = batches * batch_size
+                        # renders run one after another, so the rate is per core
+                        self.stdout.write(
+                            f'{path} (batch of {batch_size}): {rendered / elapsed:.1f} renders/s per core, '
+                            f'{elapsed / rendered * 1000:.2f} ms per render'
+                        )
+            finally:
+                renderer.stop()
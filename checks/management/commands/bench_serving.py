@@ -0,0 +1,100 @@
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from checks.models import Printer
+
+SERVERS = {
+    'wsgi': ['gen_checks.wsgi:application', '--worker-class', 'gthread'],
+    'asgi': ['gen_checks.asgi:application', '--worker-class', 'uvicorn.workers.UvicornWorker'],
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare long-poll requests per second of the sync WSGI and the async ASGI serving paths, '
+        'every server runs one gunicorn worker process'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--server', action='append', dest='servers', choices=SERVERS, help='Repeatable, all by default'
+        )
+        parser.add_argument('--concurrency', type=int, default=80, help='Requests in flight')
+        parser.add_argument('--requests', type=int, default=400, help='Requests per server')
+        parser.add_argument('--wait', type=float, default=1, help='Long-poll wait of every request')
+        parser.add_argument('--threads', type=int, default=8, help='Threads of the WSGI worker')
+        parser.add_argument('--api-key', help='Api key of the polling printer, the first printer by default')
+
+    def handle(self, *args, **options):
+        api_key = options['api_key']
+        if api_key is None:
+            api_key = Printer.objects.order_by('pk').values_list('api_key', flat=True).first()
+        if api_key is None:
+            raise CommandError('No printer to poll for')
+        for server in options['servers'] or list(SERVERS):
+            port = free_port()
+            process = subprocess.Popen(
+                [
+                    sys.executable, '-m', 'gunicorn', *SERVERS[server], '--bind', f'127.0.0.1:{port}',
+                    '--workers', '1', '--threads', str(options['threads']), '--log-level', 'warning'
+                ],
+                cwd=settings.BASE_DIR,
+                env={**os.environ, 'CHECKS_EVENTS_BACKEND': 'checks.events.InMemoryEvents'}
+            )
+            try:
+                url = f'http://127.0.0.1:{port}/checks/for-print/{api_key}/?wait={options["wait"]}'
+                wait_for_port(port)
+                latencies, elapsed = run_load(url, options['concurrency'], options['requests'])
+            finally:
+                process.terminate()
+                process.wait()
+            latencies.sort()
+            self.stdout.write(
+                f'{server}: {len(latencies) / elapsed:.1f} requests/s, '
+                f'p50 {statistics.median(latencies) * 1000:.0f} ms, '
+                f'p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:.0f} ms '
+                f'at {options["concurrency"]} concurrent long-polls of {options["wait"]} s'
+            )
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise CommandError(f'Server on port {port} did not start')
+
+
+def run_load(url, concurrency, count):
+    """Returns latencies of count GET requests sent concurrency at a time and elapsed seconds"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+
+    def get(_):
+        started_at = time.perf_counter()
+        session.get(url).raise_for_status()
+        return time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(get, range(count)))
+    return latencies, time.perf_counter() - started_at
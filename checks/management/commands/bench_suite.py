@@ -0,0 +1,257 @@
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from itertools import islice
+
+import django
+from celery.contrib.testing.worker import start_worker
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from checks import models
+from checks.benchmarks import OrderGenerator, StubRenderer, compare_results, run_load, summarize
+from checks.celery import app
+from checks.client import reset_client
+from checks.tasks import BACKFILL_QUEUE, CHECK_QUEUES
+
+SCENARIOS = ('e2e', 'ingest', 'for-print', 'download')
+
+
+class Command(BaseCommand):
+    help = (
+        'Run the benchmark suite on a temporary PostgreSQL database with a stub wkhtmltopdf service, '
+        'an in-memory broker and a worker in the process, results are written as JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scenario',
+            action='append',
+            dest='scenarios',
+            choices=SCENARIOS,
+            help='Scenario to run, may be repeated, all by default'
+        )
+        parser.add_argument('--orders', type=int, default=200, help='Orders of the e2e and ingest scenarios')
+        parser.add_argument('--polls', type=int, default=1000, help='Requests of the for-print scenario')
+        parser.add_argument('--downloads', type=int, default=200, help='Requests of the download scenario')
+        parser.add_argument('--file-size', type=int, default=128 * 1024, help='Bytes of the downloaded file')
+        parser.add_argument('--concurrency', type=int, default=8, help='Client threads')
+        parser.add_argument('--workers', type=int, default=4, help='Threads of the celery worker')
+        parser.add_argument('--latency', type=float, default=0.05, help='Seconds the stub renderer takes')
+        parser.add_argument('--jitter', type=float, default=0.02, help='Random seconds added to the latency')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of orders and jitter')
+        parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for checks to render')
+        parser.add_argument('--output', default='-', help='JSON results file, stdout by default')
+        parser.add_argument('--results', help='Compare this results file instead of running the suite')
+        parser.add_argument('--baseline', help='Results file to compare p95 latencies with')
+        parser.add_argument(
+            '--threshold', type=float, default=10, help='Fail when a p95 latency grows by more percent'
+        )
+
+    def handle(self, *args, **options):
+        if options['results']:
+            with open(options['results']) as f:
+                results = json.load(f)
+        else:
+            results = self.run(options)
+            output = json.dumps(results, indent=2)
+            if options['output'] == '-':
+                self.stdout.write(output)
+            else:
+                with open(options['output'], 'w') as f:
+                    f.write(output + '\n')
+                for name, result in results['scenarios'].items():
+                    self.stdout.write(
+                        f'{name}: {result["throughput"]}/s, p50 {result["p50"]} ms, p95 {result["p95"]} ms, '
+                        f'{result["errors"]} errors'
+                    )
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = compare_results(baseline, results, options['threshold'])
+            for regression in regressions:
+                self.stderr.write(regression)
+            if regressions:
+                raise CommandError(
+                    f'{len(regressions)} scenarios regressed by more than {options["threshold"]}% on p95'
+                )
+
+    def run(self, options):
+        """Run scenarios on a new database created as for tests and dropped afterwards"""
+        # a worker of this process consumes the tasks, nothing leaves the process
+        app.conf.update(
+            CELERY_BROKER_URL='memory://localhost/',
+            # virtual transports poll empty queues, once a second by default
+            CELERY_BROKER_TRANSPORT_OPTIONS={'polling_interval': 0.01},
+            # the sync loop of virtual transports refills a full prefetch window only every 2 seconds
+            CELERY_WORKER_PREFETCH_MULTIPLIER=0,
+            CELERY_RESULT_BACKEND=None
+        )
+        connection = connections['default']
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with tempfile.TemporaryDirectory() as media_root, StubRenderer(
+                latency=options['latency'], jitter=options['jitter'], seed=options['seed']
+            ) as stub, override_settings(
+                ALLOWED_HOSTS=['testserver'],
+                DEBUG=False,
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                CHECKS_EVENTS_BACKEND='checks.events.InMemoryEvents',
+                CHECKS_RENDERER='checks.renderers.RemoteRenderer',
+                WKHTMLTOPDF_URL=stub.url,
+                MEDIA_ROOT=media_root,
+                STORAGES={**settings.STORAGES, 'default': {'BACKEND': 'checks.storage.LocalStorage'}}
+            ):
+                # the renderer client keeps the url it was created with
+                reset_client()
+                try:
+                    self.setup_data(options)
+                    scenarios = {
+                        name: getattr(self, f'run_{name.replace("-", "_")}')(options)
+                        for name in SCENARIOS if name in (options['scenarios'] or SCENARIOS)
+                    }
+                finally:
+                    reset_client()
+        finally:
+            try:
+                close_sessions(connection)
+                connections.close_all()
+            finally:
+                # the temporary database is dropped even when its sessions could not be closed
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+        return {
+            'meta': {
+                'revision': get_revision(),
+                'created_at': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'options': {
+                    key: options[key] for key in (
+                        'orders', 'polls', 'downloads', 'file_size', 'concurrency',
+                        'workers', 'latency', 'jitter', 'seed'
+                    )
+                }
+            },
+            'scenarios': scenarios
+        }
+
+    def setup_data(self, options):
+        self.merchant_point = models.MerchantPoint.objects.create(name='bench', address='Bench Street, 1')
+        for check_type in ('kitchen', 'client'):
+            models.Printer.objects.create(
+                name=f'bench {check_type}', check_type=check_type, merchant_point=self.merchant_point
+            )
+        # orders of the merchant point are not routed to the polled printer
+        self.poll_printer = models.Printer.objects.create(
+            name='bench poll',
+            check_type='kitchen',
+            merchant_point=models.MerchantPoint.objects.create(name='bench poll', address='Bench Street, 2')
+        )
+        self.orders = OrderGenerator(self.merchant_point.pk, seed=options['seed'])
+
+    def post_orders(self, options):
+        """Returns uuids of created orders, latencies, errors and elapsed seconds of the requests"""
+        orders = list(islice(self.orders, options['orders']))
+        order_uuids = []
+
+        def post(number):
+            resp = Client().post('/checks/', {'order': orders[number]}, content_type='application/json')
+            if resp.status_code != 201:
+                raise ValueError(f'{resp.status_code}: {resp.content[:200]}')
+            order_uuids.append(resp.json()['uuid'])
+
+        return (order_uuids, *run_load(post, len(orders), options['concurrency']))
+
+    def run_ingest(self, options):
+        """Orders created per second, tasks are left in the broker as no worker runs"""
+        _, latencies, errors, elapsed = self.post_orders(options)
+        return summarize(latencies, elapsed, errors)
+
+    def run_e2e(self, options):
+        """Latency from the creation of a check to it being rendered"""
+        queues = [*CHECK_QUEUES.values(), BACKFILL_QUEUE, settings.CELERY_TASK_DEFAULT_QUEUE]
+        with start_worker(
+            app,
+            pool='threads',
+            concurrency=options['workers'],
+            queues=queues,
+            perform_ping_check=False,
+            loglevel='WARNING'
+        ):
+            order_uuids, _, errors, _ = self.post_orders(options)
+            checks = models.Check.objects.filter(order_uuid__in=order_uuids)
+            deadline = time.monotonic() + options['timeout']
+            while checks.filter(status='new').exists() and time.monotonic() < deadline:
+                time.sleep(0.05)
+        rows = list(checks.values_list('pk', 'status', 'created_at', 'updated_at'))
+        latencies = [(updated_at - created_at).total_seconds() for _, status, created_at, updated_at in rows
+                     if status == 'rendered']
+        errors += [f'Check {pk} is {status}' for pk, status, _, _ in rows if status != 'rendered']
+        elapsed = (max(row[3] for row in rows) - min(row[2] for row in rows)).total_seconds() if rows else 0
+        return summarize(latencies, elapsed, errors)
+
+    def run_for_print(self, options):
+        """Short polls of a printer with a page of rendered checks"""
+        models.Check.objects.bulk_create([
+            models.Check(
+                printer=self.poll_printer,
+                check_type=self.poll_printer.check_type,
+                order=order,
+                status='rendered',
+                pdf_file='bench/check.pdf'
+            )
+            for order in islice(self.orders, 10)
+        ])
+        url = f'/checks/for-print/{self.poll_printer.api_key}/'
+
+        def poll(number):
+            resp = Client().get(url)
+            if resp.status_code != 200:
+                raise ValueError(f'{resp.status_code}: {resp.content[:200]}')
+
+        latencies, errors, elapsed = run_load(poll, options['polls'], options['concurrency'])
+        return summarize(latencies, elapsed, errors)
+
+    def run_download(self, options):
+        """Downloads of a rendered file"""
+        name = default_storage.save('bench/download.pdf', ContentFile(os.urandom(options['file_size'])))
+        url = reverse('media', args=[name])
+
+        def download(number):
+            resp = Client().get(url)
+            content = b''.join(resp.streaming_content) if resp.streaming else resp.content
+            if resp.status_code != 200 or len(content) != options['file_size']:
+                raise ValueError(f'{resp.status_code}: {len(content)} bytes')
+
+        latencies, errors, elapsed = run_load(download, options['downloads'], options['concurrency'])
+        result = summarize(latencies, elapsed, errors)
+        result['mb_per_second'] = round(len(latencies) * options['file_size'] / elapsed / 2 ** 20, 1)
+        return result
+
+
+def close_sessions(connection):
+    """Close connections to the database left by threads of the worker, they exit without closing them"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT pg_terminate_backend(pid) FROM pg_stat_activity '
+            'WHERE datname = current_database() AND pid <> pg_backend_pid()'
+        )
+
+
+def get_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=settings.BASE_DIR
+        ).stdout.strip() or None
+    except OSError:
+        return None
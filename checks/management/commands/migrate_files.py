@@ -0,0 +1,87 @@
+import hashlib
+import posixpath
+from collections import Counter
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from checks.cache import render_cache
+from checks.models import Check, RenderedFile
+
+
+class Command(BaseCommand):
+    help = (
+        'Move rendered files from a local directory into the configured storage. '
+        'Flat files of checks become content-addressed ones in sharded directories, '
+        'Check.pdf_file is rewritten in batches'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source',
+            default=str(settings.MEDIA_ROOT),
+            help='Directory with the files, MEDIA_ROOT by default'
+        )
+        parser.add_argument('--batch-size', type=int, default=500, help='Checks per update')
+        parser.add_argument('--keep', action='store_true', help='Keep moved files in the source directory')
+
+    def handle(self, *args, **options):
+        source = FileSystemStorage(location=options['source'])
+        copied = self.copy_cached(source, options['batch_size'])
+        moved = self.move_flat(source, options['batch_size'], options['keep'])
+        self.stdout.write(f'Copied {copied} cached files, moved {moved} files of checks')
+
+    @staticmethod
+    def copy_cached(source, batch_size):
+        """Copy content-addressed files missing in the storage, their names stay the same"""
+        copied = 0
+        for name in RenderedFile.objects.values_list('file', flat=True).iterator(chunk_size=batch_size):
+            if source.exists(name) and not default_storage.exists(name):
+                with source.open(name) as f:
+                    default_storage.save(name, f)
+                copied += 1
+        return copied
+
+    @staticmethod
+    def move_flat(source, batch_size, keep):
+        moved = 0
+        last_pk = 0
+        while True:
+            checks = list(
+                Check.objects.filter(pk__gt=last_pk).exclude(pdf_file__isnull=True).exclude(
+                    pdf_file=''
+                ).exclude(pdf_file__startswith=f'{render_cache.prefix}/').order_by('pk')[:batch_size]
+            )
+            if not checks:
+                return moved
+            last_pk = checks[-1].pk
+
+            files = {}
+            refs = Counter()
+            old_names = []
+            for check in checks:
+                old_name = check.pdf_file.name
+                if not source.exists(old_name):
+                    continue
+                with source.open(old_name) as f:
+                    content = f.read()
+                digest = hashlib.sha256(content).hexdigest()
+                name = render_cache.make_name(digest, posixpath.splitext(old_name)[1][1:] or 'pdf')
+                if digest not in files and not default_storage.exists(name):
+                    default_storage.save(name, ContentFile(content))
+                files[digest] = (name, len(content))
+                refs[digest] += 1
+                check.pdf_file = name
+                old_names.append(old_name)
+
+            with transaction.atomic():
+                for digest, count in refs.items():
+                    render_cache.store(digest, *files[digest], count=count)
+                Check.objects.bulk_update(checks, ['pdf_file'])
+            if not keep:
+                for old_name in old_names:
+                    source.delete(old_name)
+            moved += len(old_names)
@@ -0,0 +1,17 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from checks.cache import render_cache
+
+
+class Command(BaseCommand):
+    help = 'Show hit rate and size of the rendered files cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset hit and miss counters')
+
+    def handle(self, *args, **options):
+        self.stdout.write(json.dumps(render_cache.get_stats(), indent=2))
+        if options['reset']:
+            render_cache.reset_stats()
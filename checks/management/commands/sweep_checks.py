@@ -0,0 +1,22 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from checks.sweeper import sweep_stuck_checks
+
+
+class Command(BaseCommand):
+    help = 'Re-enqueue checks stuck in new, checks out of attempts are marked failed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Checks per re-enqueue')
+        parser.add_argument('--stuck-after', type=int, help='Seconds a check may stay new')
+        parser.add_argument('--max-attempts', type=int, help='Re-enqueues before a check is failed')
+
+    def handle(self, *args, **options):
+        result = sweep_stuck_checks(
+            batch_size=options['batch_size'],
+            stuck_after=options['stuck_after'],
+            max_attempts=options['max_attempts']
+        )
+        self.stdout.write(json.dumps(result, indent=2))
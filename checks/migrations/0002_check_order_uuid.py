@@ -0,0 +1,38 @@
+# Generated by Django 4.2.3 on 2026-10-17 21:36
+
+from django.db import migrations, models
+from django.db.models.fields.json import KeyTextTransform
+from django.db.models.functions import Cast
+
+BATCH_SIZE = 10000
+
+
+def backfill_order_uuid(apps, schema_editor):
+    """Copy order['uuid'] into order_uuid in primary key ranges"""
+    Check = apps.get_model('checks', 'Check')
+    last_pk = Check.objects.aggregate(models.Max('pk'))['pk__max'] or 0
+    for start in range(0, last_pk + 1, BATCH_SIZE):
+        Check.objects.filter(
+            pk__gte=start, pk__lt=start + BATCH_SIZE, order_uuid__isnull=True
+        ).update(
+            order_uuid=Cast(KeyTextTransform('uuid', 'order'), models.UUIDField())
+        )
+
+
+class Migration(migrations.Migration):
+
+    # Backfill batches are committed one by one to avoid locking the whole table
+    atomic = False
+
+    dependencies = [
+        ('checks', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='check',
+            name='order_uuid',
+            field=models.UUIDField(db_index=True, editable=False, null=True, verbose_name='Order UUID'),
+        ),
+        migrations.RunPython(backfill_order_uuid, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.3 on 2026-10-17 21:36
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # The index is built without blocking writes to checks_check
+    atomic = False
+
+    dependencies = [
+        ('checks', '0002_check_order_uuid'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='check',
+            index=models.Index(fields=['printer', 'status', 'id'], name='check_printer_status_idx'),
+        ),
+    ]
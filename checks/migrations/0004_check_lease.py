@@ -0,0 +1,23 @@
+# Generated by Django 4.2.3 on 2026-10-17 21:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checks', '0003_check_printer_status_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='check',
+            name='lease_id',
+            field=models.UUIDField(editable=False, null=True, verbose_name='Lease ID'),
+        ),
+        migrations.AddField(
+            model_name='check',
+            name='leased_until',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='Leased until'),
+        ),
+    ]
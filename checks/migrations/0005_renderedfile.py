@@ -0,0 +1,28 @@
+# Generated by Django 4.2.3 on 2026-10-17 21:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checks', '0004_check_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RenderedFile',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='Content digest')),
+                ('file', models.FileField(upload_to='', verbose_name='File')),
+                ('size', models.PositiveBigIntegerField(verbose_name='Size')),
+                ('ref_count', models.PositiveIntegerField(default=0, verbose_name='Reference count')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Creation date')),
+                ('last_used_at', models.DateTimeField(auto_now=True, db_index=True, verbose_name='Last used date')),
+            ],
+            options={
+                'verbose_name': 'rendered file',
+                'verbose_name_plural': 'rendered files',
+            },
+        ),
+    ]
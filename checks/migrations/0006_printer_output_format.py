@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-17 21:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checks', '0005_renderedfile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='printer',
+            name='output_format',
+            field=models.CharField(choices=[('pdf', 'PDF'), ('escpos', 'ESC/POS')], default='pdf', max_length=10, verbose_name='Output format'),
+        ),
+    ]
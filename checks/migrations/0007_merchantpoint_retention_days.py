@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-17 21:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checks', '0006_printer_output_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='merchantpoint',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, help_text='Days printed checks are kept before archiving, the default policy if empty', null=True, verbose_name='Retention days'),
+        ),
+    ]
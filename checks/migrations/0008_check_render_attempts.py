@@ -0,0 +1,23 @@
+# Generated by Django 4.2.3 on 2026-10-17 21:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checks', '0007_merchantpoint_retention_days'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='check',
+            name='render_attempts',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Render attempts'),
+        ),
+        migrations.AlterField(
+            model_name='check',
+            name='status',
+            field=models.CharField(choices=[('new', 'New'), ('rendered', 'Rendered'), ('printed', 'Printed'), ('failed', 'Failed')], default='new', max_length=10, verbose_name='Status of check'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.3 on 2026-10-17 21:59
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # The index is built without blocking writes to checks_check
+    atomic = False
+
+    dependencies = [
+        ('checks', '0008_check_render_attempts'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='check',
+            index=models.Index(fields=['status', 'created_at'], name='check_status_created_idx'),
+        ),
+    ]
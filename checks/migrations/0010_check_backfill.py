@@ -0,0 +1,18 @@
+# Generated by Django 4.2.3 on 2026-10-17 22:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checks', '0009_check_status_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='check',
+            name='backfill',
+            field=models.BooleanField(default=False, editable=False, verbose_name='Backfill'),
+        ),
+    ]
@@ -6,10 +6,16 @@ TYPE_OF_CHECK = [
     ('client', 'Client'),
 ]
 
+OUTPUT_FORMAT = [
+    ('pdf', 'PDF'),
+    ('escpos', 'ESC/POS'),
+]
+
 STATUS_OF_CHECK = [
     ('new', 'New'),
     ('rendered', 'Rendered'),
     ('printed', 'Printed'),
+    ('failed', 'Failed'),
 ]
 
 
@@ -22,6 +28,10 @@ class MerchantPoint(models.Model):
 
     name = models.CharField(max_length=100, verbose_name='Name')
     address = models.CharField(max_length=250, verbose_name='Address')
+    retention_days = models.PositiveIntegerField(
+        null=True, blank=True, verbose_name='Retention days',
+        help_text='Days printed checks are kept before archiving, the default policy if empty'
+    )
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Creation date')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated date')
 
@@ -39,6 +49,8 @@ class Printer(models.Model):
     name = models.CharField(max_length=100, verbose_name='Name')
     api_key = models.CharField(default=uuid.uuid4, unique=True, verbose_name='API access key')
     check_type = models.CharField(max_length=10, choices=TYPE_OF_CHECK, verbose_name='Type of check')
+    output_format = models.CharField(max_length=10, default='pdf', choices=OUTPUT_FORMAT,
+                                     verbose_name='Output format')
     merchant_point = models.ForeignKey(to=MerchantPoint, on_delete=models.PROTECT,
                                        verbose_name='Merchant point')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Creation date')
@@ -54,15 +66,43 @@ class Check(models.Model):
     class Meta:
         verbose_name = 'check'
         verbose_name_plural = 'checks'
+        indexes = [
+            models.Index(fields=['printer', 'status', 'id'], name='check_printer_status_idx'),
+            models.Index(fields=['status', 'created_at'], name='check_status_created_idx'),
+        ]
 
     printer = models.ForeignKey(to=Printer, on_delete=models.PROTECT, verbose_name='Printer')
     check_type = models.CharField(max_length=10, choices=TYPE_OF_CHECK, verbose_name='Type of check')
     order = models.JSONField(verbose_name='Order data')
+    order_uuid = models.UUIDField(null=True, editable=False, db_index=True, verbose_name='Order UUID')
     status = models.CharField(max_length=10, default='new', choices=STATUS_OF_CHECK,
                               verbose_name='Status of check')
     pdf_file = models.FileField(null=True, verbose_name='PDF file')
+    render_attempts = models.PositiveSmallIntegerField(default=0, editable=False,
+                                                       verbose_name='Render attempts')
+    backfill = models.BooleanField(default=False, editable=False, verbose_name='Backfill')
+    lease_id = models.UUIDField(null=True, editable=False, verbose_name='Lease ID')
+    leased_until = models.DateTimeField(null=True, editable=False, verbose_name='Leased until')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Creation date')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Updated date')
 
     def __str__(self):
         return f"Check #{self.id}"
+
+
+class RenderedFile(models.Model):
+    """Content-addressed rendered file shared by checks with the same content"""
+
+    class Meta:
+        verbose_name = 'rendered file'
+        verbose_name_plural = 'rendered files'
+
+    digest = models.CharField(max_length=64, primary_key=True, verbose_name='Content digest')
+    file = models.FileField(verbose_name='File')
+    size = models.PositiveBigIntegerField(verbose_name='Size')
+    ref_count = models.PositiveIntegerField(default=0, verbose_name='Reference count')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Creation date')
+    last_used_at = models.DateTimeField(auto_now=True, db_index=True, verbose_name='Last used date')
+
+    def __str__(self):
+        return self.digest
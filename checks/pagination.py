@@ -0,0 +1,13 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class ForPrintPagination(CursorPagination):
+    """
+    Keyset pagination for checks polled by printers.
+    Pages are an index range scan on (printer, status, id) without COUNT(*)
+    """
+    ordering = 'pk'
+    page_size = settings.CHECKS_FOR_PRINT_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.CHECKS_FOR_PRINT_MAX_PAGE_SIZE
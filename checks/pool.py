@@ -0,0 +1,196 @@
+import logging
+import os
+import queue
+import selectors
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+from checks.renderers import RenderError
+
+log = logging.getLogger(__name__)
+
+
+class RendererProcess:
+    """
+    Persistent wkhtmltopdf process started with --read-args-from-stdin.
+    Every line written to stdin converts one document, wkhtmltopdf reports
+    the end of each conversion with a Done/Failed line on stderr
+    """
+
+    def __init__(self, binary, options, workdir):
+        self.options = [option for option in options if option not in ('-q', '--quiet')]
+        self.workdir = workdir
+        self.jobs = 0
+        self.process = subprocess.Popen(
+            [binary, '--read-args-from-stdin'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        self.buffer = b''
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    @property
+    def is_alive(self):
+        return self.process.poll() is None
+
+    @property
+    def memory(self):
+        """Resident memory of the process in bytes, 0 if unknown"""
+        try:
+            with open(f'/proc/{self.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def render(self, html, path, timeout):
+        """Write PDF of the HTML to path, wkhtmltopdf writes the file itself"""
+        in_path = os.path.join(self.workdir, f'{uuid.uuid4().hex}.html')
+        with open(in_path, 'w', encoding='utf-8') as f:
+            f.write(html)
+        try:
+            line = shlex.join([*self.options, in_path, os.fspath(path)]) + '\n'
+            self.process.stdin.write(line.encode('utf-8'))
+            self.process.stdin.flush()
+            status, errors = self.wait(deadline=time.monotonic() + timeout)
+            self.jobs += 1
+            if status != 'Done':
+                raise RenderError('; '.join(errors) or f'wkhtmltopdf {status}')
+        except OSError as err:
+            raise RenderError(err) from err
+        finally:
+            os.remove(in_path)
+
+    def wait(self, deadline):
+        """Read stderr until the end of the current conversion, returns its status and errors"""
+        errors = []
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.process.stderr, selectors.EVENT_READ)
+            while True:
+                while b'\n' in self.buffer:
+                    line, self.buffer = self.buffer.split(b'\n', 1)
+                    # progress bars are redrawn with carriage returns
+                    line = line.split(b'\r')[-1].decode('utf-8', 'replace').strip()
+                    if line in ('Done', 'Failed'):
+                        return line, errors
+                    if line.startswith(('Error', 'Exit with code')):
+                        errors.append(line)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RenderError('wkhtmltopdf timed out')
+                if not selector.select(timeout=remaining):
+                    continue
+                chunk = os.read(self.process.stderr.fileno(), 65536)
+                if not chunk:
+                    raise RenderError('wkhtmltopdf exited')
+                self.buffer += chunk
+
+    def close(self):
+        if self.is_alive:
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process.stderr.close()
+
+
+class RendererPool:
+    """
+    Pool of warm wkhtmltopdf processes of a worker process.
+    Processes are recycled after max_jobs conversions or when
+    their resident memory exceeds max_memory bytes
+    """
+
+    def __init__(self, size, binary, options, timeout, max_jobs, max_memory):
+        self.size = size
+        self.binary = binary
+        self.options = options
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.workdir = tempfile.mkdtemp(prefix='checks-renderer-')
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.processes = set()
+        for _ in range(size):
+            try:
+                self.idle.put(self.spawn())
+            except RenderError as err:
+                log.error(err)
+
+    def spawn(self):
+        try:
+            process = RendererProcess(binary=self.binary, options=self.options, workdir=self.workdir)
+        except OSError as err:
+            raise RenderError(err) from err
+        with self.lock:
+            self.processes.add(process)
+        return process
+
+    def retire(self, process):
+        with self.lock:
+            self.processes.discard(process)
+        process.close()
+
+    def should_recycle(self, process):
+        if not process.is_alive:
+            return True
+        if self.max_jobs and process.jobs >= self.max_jobs:
+            return True
+        return bool(self.max_memory) and process.memory > self.max_memory
+
+    def acquire(self):
+        """Returns an idle process, processes lost to failed spawns are started again"""
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            is_full = len(self.processes) >= self.size
+        if not is_full:
+            return self.spawn()
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RenderError('No idle renderer process')
+
+    def release(self, process, failed):
+        if failed or self.should_recycle(process):
+            log.info(f'Recycle renderer process {process.pid} after {process.jobs} jobs')
+            self.retire(process)
+            try:
+                process = self.spawn()
+            except RenderError as err:
+                log.error(err)
+                return
+        self.idle.put(process)
+
+    def render(self, html, path):
+        process = self.acquire()
+        failed = True
+        try:
+            process.render(html, path, timeout=self.timeout)
+            failed = False
+        finally:
+            self.release(process, failed)
+
+    def close(self):
+        with self.lock:
+            processes = list(self.processes)
+            self.processes.clear()
+        for process in processes:
+            process.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
@@ -0,0 +1,257 @@
+import os
+import subprocess
+import tempfile
+from functools import lru_cache
+from html.parser import HTMLParser
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from pypdf import PdfReader, PdfWriter
+
+from checks.client import get_client
+
+BATCH_MARKER = '[[batch-document-{}]]'
+PAGE_BREAK = '<div style="page-break-before: always"></div>'
+
+
+class RenderError(Exception):
+    """Raised when a renderer fails to convert HTML to PDF"""
+
+
+class BaseRenderer:
+    """Base class of HTML to PDF renderers"""
+    # renderers with a per call overhead join batches into one document
+    batch = False
+
+    def start(self):
+        """Prepare the renderer in a new worker process"""
+
+    def stop(self):
+        """Release resources of the renderer on worker process shutdown"""
+
+    def render(self, html, path):
+        """Write PDF of the HTML document to path"""
+        raise NotImplementedError
+
+    def render_many(self, documents):
+        """Write PDFs of (html, path) pairs, in one render call for batch renderers"""
+        if not self.batch or len(documents) < 2:
+            for html, path in documents:
+                self.render(html, path)
+            return
+        fd, batch_path = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        try:
+            self.render(join_documents([html for html, _ in documents]), batch_path)
+            split_pdf(batch_path, [path for _, path in documents])
+        finally:
+            os.remove(batch_path)
+
+
+class RemoteRenderer(BaseRenderer):
+    """
+    Renderer over the wkhtmltopdf HTTP service.
+    HTML is sent as a multipart upload and the PDF is streamed to the file in chunks
+    """
+    batch = True
+    chunk_size = 64 * 1024
+
+    def render(self, html, path):
+        resp = get_client().post(
+            files={'file': ('check.html', html.encode('utf-8'), 'text/html')},
+            stream=True
+        )
+        with resp, open(path, 'wb') as f:
+            for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                f.write(chunk)
+
+
+class LocalRenderer(BaseRenderer):
+    """Renderer over the wkhtmltopdf binary installed in the worker image"""
+    batch = True
+
+    def __init__(self, binary=None, options=None, timeout=None):
+        self.binary = binary or settings.WKHTMLTOPDF_BINARY
+        self.options = settings.WKHTMLTOPDF_OPTIONS if options is None else options
+        self.timeout = timeout or settings.WKHTMLTOPDF_READ_TIMEOUT
+
+    def render(self, html, path):
+        try:
+            with open(path, 'wb') as f:
+                # wkhtmltopdf writes the PDF straight into the file
+                result = subprocess.run(
+                    [self.binary, *self.options, '-', '-'],
+                    input=html.encode('utf-8'),
+                    stdout=f,
+                    stderr=subprocess.PIPE,
+                    timeout=self.timeout
+                )
+        except (OSError, subprocess.TimeoutExpired) as err:
+            raise RenderError(err) from err
+        if result.returncode != 0:
+            raise RenderError(result.stderr.decode('utf-8', 'replace').strip())
+
+
+class PooledRenderer(BaseRenderer):
+    """Renderer over a pool of warm wkhtmltopdf processes of the worker process"""
+    batch = True
+
+    def __init__(self):
+        self.pool = None
+        self.pid = None
+
+    def start(self):
+        from checks.pool import RendererPool
+
+        self.stop()
+        self.pool = RendererPool(
+            size=settings.CHECKS_RENDERER_POOL_SIZE,
+            binary=settings.WKHTMLTOPDF_BINARY,
+            options=settings.WKHTMLTOPDF_OPTIONS,
+            timeout=settings.WKHTMLTOPDF_READ_TIMEOUT,
+            max_jobs=settings.CHECKS_RENDERER_MAX_JOBS,
+            max_memory=settings.CHECKS_RENDERER_MAX_MEMORY
+        )
+        self.pid = os.getpid()
+
+    def stop(self):
+        # processes of a forked parent belong to the parent
+        if self.pool is not None and self.pid == os.getpid():
+            self.pool.close()
+        self.pool = None
+
+    def render(self, html, path):
+        if self.pool is None or self.pid != os.getpid():
+            self.start()
+        self.pool.render(html, path)
+
+
+class TextExtractor(HTMLParser):
+    """Collects text lines of HTML body"""
+    block_tags = {'div', 'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'tr', 'br', 'table'}
+    skip_tags = {'head', 'style', 'script', 'title'}
+
+    def __init__(self):
+        super().__init__()
+        self.lines = ['']
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skip_tags:
+            self.skip += 1
+        elif tag in self.block_tags:
+            self.break_line()
+
+    def handle_endtag(self, tag):
+        if tag in self.skip_tags:
+            self.skip -= 1
+        elif tag in self.block_tags:
+            self.break_line()
+
+    def handle_data(self, data):
+        text = ' '.join(data.split())
+        if text and not self.skip:
+            self.lines[-1] = f'{self.lines[-1]} {text}'.strip()
+
+    def break_line(self):
+        if self.lines[-1]:
+            self.lines.append('')
+
+
+class SimpleRenderer(BaseRenderer):
+    """
+    Pure Python renderer writing text lines of the HTML into a PDF.
+    Keeps no layout, used for tests and environments without wkhtmltopdf
+    """
+    lines_per_page = 60
+
+    def render(self, html, path):
+        extractor = TextExtractor()
+        extractor.feed(html)
+        lines = [line for line in extractor.lines if line]
+        pages = [
+            lines[i:i + self.lines_per_page] for i in range(0, len(lines), self.lines_per_page)
+        ] or [[]]
+        with open(path, 'wb') as f:
+            f.write(self.build_pdf(pages))
+
+    @staticmethod
+    def escape(text):
+        text = text.encode('latin-1', 'replace').decode('latin-1')
+        return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+    def build_pdf(self, pages):
+        page_ids = [4 + i * 2 for i in range(len(pages))]
+        objects = [
+            b'<< /Type /Catalog /Pages 2 0 R >>',
+            b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+                b' '.join(b'%d 0 R' % page_id for page_id in page_ids), len(pages)
+            ),
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+        ]
+        for page_id, lines in zip(page_ids, pages):
+            text = ''.join(f'({self.escape(line)}) Tj T* ' for line in lines)
+            stream = f'BT /F1 11 Tf 14 TL 40 800 Td {text}ET'.encode('latin-1')
+            objects.append(
+                b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+                b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % (page_id + 1)
+            )
+            objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+
+        pdf = bytearray(b'%PDF-1.4\n')
+        offsets = []
+        for number, obj in enumerate(objects, start=1):
+            offsets.append(len(pdf))
+            pdf += b'%d 0 obj\n%s\nendobj\n' % (number, obj)
+        xref = len(pdf)
+        pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+        pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+        pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+            len(objects) + 1, xref
+        )
+        return bytes(pdf)
+
+
+def join_documents(htmls):
+    """
+    Joins HTML documents into one with every document starting on a new page.
+    Documents share the head of the first one and start with an invisible marker
+    """
+    head = htmls[0].split('<body>', 1)[0]
+    bodies = [
+        f'<div style="font-size: 1px; color: #fff">{BATCH_MARKER.format(number)}</div>'
+        f'{html.split("<body>", 1)[-1].rsplit("</body>", 1)[0]}'
+        for number, html in enumerate(htmls)
+    ]
+    return f'{head}<body>{PAGE_BREAK.join(bodies)}</body></html>'
+
+
+def split_pdf(path, paths):
+    """Split PDF of joined documents back into a PDF per document by their markers"""
+    reader = PdfReader(path)
+    starts = []
+    for number, page in enumerate(reader.pages):
+        if len(starts) < len(paths) and BATCH_MARKER.format(len(starts)) in page.extract_text():
+            starts.append(number)
+    if len(starts) != len(paths):
+        raise RenderError(f'Found {len(starts)} of {len(paths)} documents in the batch')
+    for start, end, doc_path in zip(starts, starts[1:] + [len(reader.pages)], paths):
+        writer = PdfWriter()
+        for page in reader.pages[start:end]:
+            writer.add_page(page)
+        with open(doc_path, 'wb') as f:
+            writer.write(f)
+
+
+@lru_cache(maxsize=None)
+def get_renderer():
+    """Returns renderer configured in settings"""
+    return import_string(settings.CHECKS_RENDERER)()
+
+
+@receiver(setting_changed)
+def reset_renderer(setting, **kwargs):
+    if setting == 'CHECKS_RENDERER':
+        get_renderer.cache_clear()
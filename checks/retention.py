@@ -0,0 +1,78 @@
+import gzip
+import json
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+
+from checks.cache import render_cache
+from checks.models import Check, MerchantPoint
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_FIELDS = (
+    'id', 'printer_id', 'check_type', 'order_uuid', 'order', 'status', 'pdf_file', 'created_at', 'updated_at'
+)
+
+
+def archive_merchant_point(merchant_point, batch_size=None, now=None):
+    """
+    Archive printed checks of the merchant point older than its retention policy.
+    Every batch goes to its own gzip compressed NDJSON file and is deleted in a short transaction
+    """
+    batch_size = batch_size or settings.CHECKS_ARCHIVE_BATCH_SIZE
+    days = merchant_point.retention_days
+    before = (now or timezone.now()) - timedelta(
+        days=settings.CHECKS_RETENTION_DAYS if days is None else days
+    )
+    archived = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                Check.objects.select_for_update(skip_locked=True, of=('self',)).filter(
+                    printer__merchant_point=merchant_point, status='printed', created_at__lt=before
+                ).order_by('pk').values(*ARCHIVE_FIELDS)[:batch_size]
+            )
+            if not rows:
+                break
+            name = f"archive/{merchant_point.pk}/{rows[0]['id']}-{rows[-1]['id']}.ndjson.gz"
+            default_storage.save(name, ContentFile(gzip.compress(
+                ''.join(f'{json.dumps(row, cls=DjangoJSONEncoder)}\n' for row in rows).encode('utf-8')
+            )))
+            # cached files are released in one go and evicted later, a delete of the queryset
+            # would release them by post_delete signals of every check while the rows are locked
+            render_cache.release([row['pdf_file'] for row in rows])
+            archived_checks = Check.objects.filter(pk__in=[row['id'] for row in rows])
+            archived_checks._raw_delete(archived_checks.db)
+            own_files = [
+                row['pdf_file'] for row in rows
+                if row['pdf_file'] and not render_cache.parse_digest(row['pdf_file'])
+            ]
+            transaction.on_commit(lambda names=own_files: delete_files(names))
+        archived += len(rows)
+        if len(rows) < batch_size:
+            break
+    if archived:
+        log.info(f'Archived {archived} checks of merchant point {merchant_point.pk}')
+    return archived
+
+
+def archive_printed_checks(merchant_point_ids=None, batch_size=None):
+    """Archive printed checks of every merchant point by its policy, returns archived count per point"""
+    merchant_points = MerchantPoint.objects.order_by('pk')
+    if merchant_point_ids:
+        merchant_points = merchant_points.filter(pk__in=merchant_point_ids)
+    return {
+        merchant_point.pk: archive_merchant_point(merchant_point, batch_size)
+        for merchant_point in merchant_points
+    }
+
+
+def delete_files(names):
+    for name in names:
+        default_storage.delete(name)
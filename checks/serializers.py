@@ -1,8 +1,11 @@
 import uuid
 
+from django.conf import settings
+from django.db import transaction
 from rest_framework import serializers
 
 from checks import models
+from checks.cache import routing
 
 
 class MerchantPointItemSerializer(serializers.ModelSerializer):
@@ -14,6 +17,7 @@ class MerchantPointItemSerializer(serializers.ModelSerializer):
             'id',
             'name',
             'address',
+            'retention_days',
             'created_at',
             'updated_at'
         )
@@ -42,6 +46,7 @@ class PrinterItemSerializer(serializers.ModelSerializer):
             'name',
             'api_key',
             'check_type',
+            'output_format',
             'merchant_point',
             'created_at',
             'updated_at'
@@ -58,6 +63,7 @@ class PrinterListSerializer(serializers.ModelSerializer):
             'url',
             'name',
             'check_type',
+            'output_format',
             'merchant_point'
         )
 
@@ -87,42 +93,62 @@ class CheckItemSerializer(serializers.ModelSerializer):
             'updated_at'
         )
 
-        # Custom attribute for caching database values
-        # used when checking and creating an object
-        printers = None
-
-        def validate_order(self, value):
-            self.validate_items(value.get('items'))
-            if not value.get('total_price'):
-                raise serializers.ValidationError('The order must contain an ' + 'total_price')
-            merchant_point = value.get('merchant_point')
-            if not merchant_point:
-                raise serializers.ValidationError('The order must contain an ' + 'merchant_point')
-            self.printers = models.Printer.objects.filter(merchant_point=merchant_point)
-            if not self.printers:
-                raise serializers.ValidationError('No printers found for the merchant point')
-            return value
-
-        def validate_items(self, items):
-            """Validate items in order"""
-            if not items or not isinstance(items, list):
-                raise serializers.ValidationError('The order must contain a non-empty list of ' + 'items')
-            for item in items:
-                is_name = item.get('name')
-                is_price = item.get('price')
-                is_count = item.get('count')
-                if not is_name or not is_price or not is_count:
-                    raise serializers.ValidationError('Each item must contain a '
-                                                      + 'name', 'price', 'count')
-
-        def create(self, validated_data):
-            instance = None
-            validated_data['order']['uuid'] = str(uuid.uuid4())
-            for printer in self.printers:
-                validated_data['printer'] = printer
-                validated_data['check_type'] = printer.check_type
-                instance = super().create(validated_data)
-            return instance
+    # Custom attribute for caching database values
+    # used when checking and creating an object
+    printers = None
+
+    # Custom attribute with every check created for the order
+    checks = None
+
+    def validate_order(self, value):
+        self.validate_items(value.get('items'))
+        if not value.get('total_price'):
+            raise serializers.ValidationError('The order must contain an ' + 'total_price')
+        merchant_point = value.get('merchant_point')
+        if not merchant_point:
+            raise serializers.ValidationError('The order must contain an ' + 'merchant_point')
+        self.printers = self.get_printers(merchant_point)
+        if not self.printers:
+            raise serializers.ValidationError('No printers found for the merchant point')
+        return value
+
+    def validate_items(self, items):
+        """Validate items in order"""
+        if not items or not isinstance(items, list):
+            raise serializers.ValidationError('The order must contain a non-empty list of ' + 'items')
+        for item in items:
+            is_name = item.get('name')
+            is_price = item.get('price')
+            is_count = item.get('count')
+            if not is_name or not is_price or not is_count:
+                raise serializers.ValidationError('Each item must contain a '
+                                                  + 'name', 'price', 'count')
+
+    @staticmethod
+    def get_printers(merchant_point):
+        """Returns printers of the merchant point from the routing table"""
+        route = routing.get(merchant_point)
+        return route.printers if route else []
+
+    def build_checks(self, validated_data):
+        """Returns unsaved checks of the order, one for every printer of the merchant point"""
+        order_uuid = uuid.uuid4()
+        validated_data['order']['uuid'] = str(order_uuid)
+        return [
+            models.Check(
+                printer_id=printer.id,
+                check_type=printer.check_type,
+                order_uuid=order_uuid,
+                **validated_data
+            )
+            for printer in self.printers
+        ]
+
+    def create(self, validated_data):
+        """Create a check for every printer of the merchant point with a single INSERT"""
+        with transaction.atomic():
+            self.checks = models.Check.objects.bulk_create(self.build_checks(validated_data))
+        return self.checks[0]
 
 
 class CheckListSerializer(serializers.ModelSerializer):
@@ -145,3 +171,18 @@ class CheckUpdateItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.Check
         fields = ('status',)
+
+
+class CheckClaimSerializer(serializers.Serializer):
+    """Serializer for claim of rendered checks by printer"""
+    limit = serializers.IntegerField(
+        min_value=1,
+        max_value=settings.CHECKS_CLAIM_MAX_LIMIT,
+        default=settings.CHECKS_CLAIM_LIMIT
+    )
+
+
+class CheckAckSerializer(serializers.Serializer):
+    """Serializer for acknowledge of printed checks by printer"""
+    lease = serializers.UUIDField()
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False)
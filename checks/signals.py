@@ -0,0 +1,37 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from checks import models
+from checks.cache import printer_keys, render_cache, routing
+
+
+@receiver(pre_save, sender=models.Printer)
+def invalidate_previous_printer_key(sender, instance, **kwargs):
+    if instance.pk is None:
+        return
+    api_key = sender.objects.filter(pk=instance.pk).values_list('api_key', flat=True).first()
+    if api_key and api_key != instance.api_key:
+        # invalidated after commit, so other processes can not cache the key again before it
+        transaction.on_commit(lambda: printer_keys.invalidate(api_key))
+
+
+@receiver(post_save, sender=models.Printer)
+@receiver(post_delete, sender=models.Printer)
+def invalidate_printer_key(sender, instance, **kwargs):
+    api_key = instance.api_key
+    transaction.on_commit(lambda: printer_keys.invalidate(api_key))
+
+
+@receiver(post_save, sender=models.Printer)
+@receiver(post_delete, sender=models.Printer)
+@receiver(post_save, sender=models.MerchantPoint)
+@receiver(post_delete, sender=models.MerchantPoint)
+def invalidate_routing(sender, **kwargs):
+    # a table rebuilt before the commit would be kept under the new version
+    transaction.on_commit(routing.invalidate)
+
+
+@receiver(post_delete, sender=models.Check)
+def release_rendered_file(sender, instance, **kwargs):
+    render_cache.release([instance.pdf_file.name])
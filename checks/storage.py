@@ -0,0 +1,193 @@
+import gzip
+import os
+import posixpath
+import shutil
+import struct
+import tempfile
+from contextlib import closing, contextmanager
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, Storage, default_storage
+from django.utils.deconstruct import deconstructible
+from django.utils.encoding import filepath_to_uri
+
+
+class TemporaryFile(File):
+    """File written to a temporary path, file system storages move it into place"""
+
+    def __init__(self, file, path):
+        super().__init__(file, name=os.path.basename(path))
+        self.path = path
+
+    def temporary_file_path(self):
+        return self.path
+
+
+@deconstructible
+class LocalStorage(FileSystemStorage):
+    """
+    File system storage of rendered files, optionally gzip compressed at rest.
+    Files are written to a hidden temporary file and moved into place,
+    so a partial file is never visible under its name. As in S3Storage an existing file
+    is replaced, a content-addressed name saved twice must not leave a renamed copy
+    """
+
+    def __init__(self, compress=None, **kwargs):
+        super().__init__(**kwargs)
+        self.compress = settings.CHECKS_STORAGE_COMPRESS if compress is None else compress
+
+    def _open(self, name, mode='rb'):
+        if not self.compress:
+            return super()._open(name, mode)
+        return File(gzip.open(self.path(name), mode), name=name)
+
+    def _save(self, name, content):
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        if not self.compress and hasattr(content, 'temporary_file_path'):
+            try:
+                self.replace(content.temporary_file_path(), full_path)
+                return name
+            except OSError:
+                # the temporary file is on another file system
+                pass
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                target = gzip.GzipFile(fileobj=f, mode='wb', mtime=0) if self.compress else f
+                with target:
+                    content.seek(0)
+                    shutil.copyfileobj(content, target)
+            self.replace(tmp_path, full_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return name
+
+    def replace(self, tmp_path, full_path):
+        # temporary files are created readable by the owner only
+        os.chmod(tmp_path, self.file_permissions_mode or 0o644)
+        os.replace(tmp_path, full_path)
+
+    def get_available_name(self, name, max_length=None):
+        # files are replaced as a whole, content-addressed names are overwritten with the same bytes
+        return name
+
+    def size(self, name):
+        if not self.compress:
+            return super().size(name)
+        # gzip trailer ends with the uncompressed size modulo 2 ** 32
+        with open(self.path(name), 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', f.read(4))[0]
+
+
+@deconstructible
+class S3Storage(Storage):
+    """
+    Storage of rendered files in an S3 compatible bucket, optionally gzip compressed at rest.
+    Uses a boto3 S3 client, files are served by the download view as local ones.
+    Files are uploaded and downloaded as streams, spooled to temporary files
+    over spool_size bytes. Compressed objects keep their uncompressed size in metadata
+    """
+    spool_size = 1024 * 1024
+
+    def __init__(self, bucket=None, prefix=None, endpoint_url=None, compress=None, client=None):
+        self.bucket = bucket or settings.CHECKS_S3_BUCKET
+        self.prefix = settings.CHECKS_S3_PREFIX if prefix is None else prefix
+        self.endpoint_url = endpoint_url or settings.CHECKS_S3_ENDPOINT_URL
+        self.compress = settings.CHECKS_STORAGE_COMPRESS if compress is None else compress
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+
+            self._client = boto3.client('s3', endpoint_url=self.endpoint_url)
+        return self._client
+
+    def key(self, name):
+        return posixpath.join(self.prefix, name) if self.prefix else name
+
+    def _open(self, name, mode='rb'):
+        body = self.client.get_object(Bucket=self.bucket, Key=self.key(name))['Body']
+        # a seekable copy for range requests
+        f = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        with closing(body):
+            shutil.copyfileobj(gzip.GzipFile(fileobj=body, mode='rb') if self.compress else body, f)
+        f.seek(0)
+        return File(f, name=name)
+
+    def _save(self, name, content):
+        content.seek(0)
+        if not self.compress:
+            self.upload(name, content, {})
+            return name
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_size) as body:
+            with gzip.GzipFile(fileobj=body, mode='wb', mtime=0) as target:
+                shutil.copyfileobj(content, target)
+                size = target.tell()
+            body.seek(0)
+            self.upload(name, body, {'uncompressed-size': str(size)})
+        return name
+
+    def upload(self, name, f, metadata):
+        """Upload the file object in parts, so it is never read into memory as a whole"""
+        self.client.upload_fileobj(f, self.bucket, self.key(name), ExtraArgs={'Metadata': metadata})
+
+    def get_available_name(self, name, max_length=None):
+        # objects are replaced as a whole, content-addressed names are overwritten with the same bytes
+        return name
+
+    def head(self, name):
+        """Returns metadata of the object or None if there is no such object"""
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except self.client.exceptions.ClientError as err:
+            if err.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, name):
+        return self.head(name) is not None
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def size(self, name):
+        head = self.head(name)
+        if not self.compress:
+            return head['ContentLength']
+        size = head.get('Metadata', {}).get('uncompressed-size')
+        if size is None:
+            # objects saved before the size was kept in metadata
+            with self.open(name) as f:
+                return f.seek(0, os.SEEK_END)
+        return int(size)
+
+    def get_modified_time(self, name):
+        return self.head(name)['LastModified']
+
+    def url(self, name):
+        return f'{settings.MEDIA_URL}{filepath_to_uri(name)}'
+
+
+@contextmanager
+def storage_path(name, storage=default_storage):
+    """
+    Yields a temporary local path to write a file to,
+    the written file is saved into the storage under name on success
+    """
+    os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=settings.MEDIA_ROOT, prefix='.', suffix='.tmp')
+    os.close(fd)
+    try:
+        yield tmp_path
+        with open(tmp_path, 'rb') as f:
+            storage.save(name, TemporaryFile(f, tmp_path))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
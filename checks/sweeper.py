@@ -0,0 +1,58 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from checks.models import Check
+
+log = logging.getLogger(__name__)
+
+
+def sweep_stuck_checks(batch_size=None, stuck_after=None, max_attempts=None, now=None):
+    """
+    Re-enqueue checks stuck in new longer than stuck_after seconds in batches to their queues.
+    Checks with a lease of a task in flight are left to it. Every re-enqueue counts
+    as an attempt, so checks of dead workers or failing with any error go to failed in the end
+    """
+    from checks.tasks import send_render_checks
+
+    batch_size = batch_size or settings.CHECKS_SWEEP_BATCH_SIZE
+    stuck_after = settings.CHECKS_SWEEP_STUCK_AFTER if stuck_after is None else stuck_after
+    max_attempts = settings.CHECKS_SWEEP_MAX_ATTEMPTS if max_attempts is None else max_attempts
+    now = now or timezone.now()
+    before = now - timedelta(seconds=stuck_after)
+    result = {'requeued': 0, 'failed': 0}
+    while True:
+        with transaction.atomic():
+            # re-enqueued checks get updated_at of now, so a sweep never takes them twice
+            checks = list(
+                Check.objects.select_for_update(skip_locked=True).filter(
+                    Q(leased_until__isnull=True) | Q(leased_until__lte=now),
+                    status='new', created_at__lt=before, updated_at__lt=before
+                ).order_by('created_at', 'pk').values_list(
+                    'pk', 'check_type', 'backfill', 'render_attempts'
+                )[:batch_size]
+            )
+            if not checks:
+                break
+            failed = [pk for pk, _, _, attempts in checks if attempts >= max_attempts]
+            requeued = [
+                (pk, check_type, backfill) for pk, check_type, backfill, attempts in checks
+                if attempts < max_attempts
+            ]
+            Check.objects.filter(pk__in=failed).update(status='failed', updated_at=now)
+            Check.objects.filter(pk__in=[pk for pk, _, _ in requeued]).update(
+                render_attempts=F('render_attempts') + 1, updated_at=now
+            )
+            if requeued:
+                transaction.on_commit(lambda requeued=requeued: send_render_checks(requeued))
+        if failed:
+            log.error(f'Checks {", ".join(map(str, failed))} failed to render')
+        result['requeued'] += len(requeued)
+        result['failed'] += len(failed)
+        if len(checks) < batch_size:
+            break
+    return result
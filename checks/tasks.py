@@ -1,51 +1,365 @@
-import json
 import logging
-from base64 import b64encode
+from contextlib import ExitStack
+from datetime import timedelta
 
 import requests
-from celery import shared_task
+from celery import group, shared_task
+from celery.signals import worker_process_init, worker_process_shutdown
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Case, Q, When
 from django.template.loader import render_to_string
+from django.utils import timezone
 
-from checks.models import Check, MerchantPoint
+from checks import retention, sweeper
+from checks.cache import render_cache, routing
+from checks.client import reset_client
+from checks.escpos import render_escpos
+from checks.events import publish_rendered
+from checks.models import Check
+from checks.renderers import RenderError, get_renderer
+from checks.storage import storage_path
 
 log = logging.getLogger(__name__)
 
+RENDER_PENDING_LOCK = 'checks:render-pending:lock'
+ARCHIVE_LOCK = 'checks:archive:lock'
+SWEEP_LOCK = 'checks:sweep:lock'
+
+KITCHEN_QUEUE = 'kitchen'
+CLIENT_QUEUE = 'client'
+BACKFILL_QUEUE = 'backfill'
+CHECK_QUEUES = {'kitchen': KITCHEN_QUEUE, 'client': CLIENT_QUEUE}
+# redis transport takes lower numbers first
+CHECK_PRIORITIES = {'kitchen': 0, 'client': 5}
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    reset_client()
+    get_renderer().start()
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    get_renderer().stop()
+
+
+def check_options(check_type, backfill=False):
+    """Queue and priority of rendering of a check, backfills never share queues with live orders"""
+    return {
+        'queue': BACKFILL_QUEUE if backfill else CHECK_QUEUES[check_type],
+        'priority': CHECK_PRIORITIES[check_type]
+    }
+
 
 @shared_task(bind=True)
-def create_checks(self, order_uuid):
-    """Task for check creation"""
-    checks = Check.objects.filter(order__uuid=order_uuid)
+def create_checks(self, order_uuid, backfill=False):
+    """Task for check creation, fans out rendering of every not rendered check of the order"""
+    checks = Check.objects.filter(order_uuid=order_uuid).values_list('pk', 'check_type', 'status')
     if not checks:
         raise ObjectDoesNotExist(f'Checks by {order_uuid} not found')
-    merchant_point = MerchantPoint.objects.get(
-        pk=checks[0].order['merchant_point'])
-    for check in checks:
-        html = render_to_string(
-            template_name='check.html',
-            context={'check': check, 'address': merchant_point.address}
+    render_new_checks(checks, backfill)
+
+
+@shared_task(bind=True)
+def create_orders(self, order_uuids, backfill=False):
+    """Task for check creation of several orders sent together"""
+    checks = Check.objects.filter(order_uuid__in=order_uuids).values_list('pk', 'check_type', 'status')
+    if not checks:
+        raise ObjectDoesNotExist(f'Checks by {", ".join(map(str, order_uuids))} not found')
+    render_new_checks(checks, backfill)
+
+
+def render_new_checks(checks, backfill=False):
+    """Fan out rendering of checks not rendered yet"""
+    if settings.CHECKS_RENDER_BATCH_SIZE > 1:
+        schedule_render_pending(backfill)
+        return
+    send_render_checks([
+        (pk, check_type, backfill) for pk, check_type, status in checks if status == 'new'
+    ])
+
+
+def send_render_checks(checks):
+    """Send a task of its own for every (pk, check_type, backfill) of checks, leased until it runs"""
+    # Kitchen checks go first as they are on the critical path of the order
+    pending = sorted((check_type != 'kitchen', pk, backfill) for pk, check_type, backfill in checks)
+    now = timezone.now()
+    for backfill in {backfill for _, _, backfill in pending}:
+        # the sweeper leaves checks with a task in flight alone
+        Check.objects.filter(pk__in=[pk for _, pk, leased in pending if leased == backfill]).update(
+            leased_until=now + timedelta(seconds=lease_timeout(backfill))
         )
-        file_name = f"{check.pk}_{check.order['uuid']}_{check.check_type}.pdf"
+    group([
+        render_check.s(pk).set(**check_options('client' if is_client else 'kitchen', backfill))
+        for is_client, pk, backfill in pending
+    ]).apply_async()
+
+
+def lease_timeout(backfill=False):
+    """Seconds a sent check is left to its task"""
+    return settings.CHECKS_BACKFILL_LEASE_TIMEOUT if backfill else settings.CHECKS_RENDER_LEASE_TIMEOUT
+
+
+@shared_task(bind=True)
+def render_check(self, check_id):
+    """Task for rendering of a single check, retried on its own"""
+    check = Check.objects.filter(pk=check_id).first()
+    if check is None:
+        raise ObjectDoesNotExist(f'Check {check_id} not found')
+    if check.status != 'new':
+        log.info(f'Check {check_id} is already {check.status}')
+        return
+    address, output_format = get_layout(check)
+    digest = render_cache.make_digest(check, address, output_format)
+    # a reference is taken in the transaction of the check update, so it is never left behind
+    with transaction.atomic():
+        file_name = render_cache.acquire(digest)
+        if file_name is not None:
+            rendered = mark_rendered([check], file_name)
+    if file_name is None:
+        content, extension = render_content(check, address, output_format)
+        file_name = render_cache.make_name(digest, extension)
         try:
-            convert_html_to_pdf(html=html, file_name=file_name)
-            check.status = 'rendered'
-            check.pdf_file = file_name
-            check.save()
-        except requests.RequestException as err:
+            if extension == 'bin':
+                save_file(content=content, file_name=file_name)
+            else:
+                convert_html_to_pdf(html=content, file_name=file_name)
+        except (requests.RequestException, RenderError) as err:
             log.error(err)
+            if self.request.retries < self.max_retries:
+                # the lease covers the countdown, so the sweeper does not re-send a check waiting for a retry
+                Check.objects.filter(pk=check.pk).update(leased_until=timezone.now() + timedelta(
+                    seconds=self.default_retry_delay + lease_timeout(check.backfill)
+                ))
             raise self.retry(exc=err)
+        size = default_storage.size(file_name)
+        with transaction.atomic():
+            render_cache.store(digest, file_name, size)
+            rendered = mark_rendered([check], file_name)
+    if rendered:
+        publish_rendered(check)
 
 
-def convert_html_to_pdf(html, file_name):
-    """Convert HTML to PDF with wkhtmltopdf"""
-    enc = 'utf-8'
-    data = b64encode(bytearray(html, encoding=enc)).decode(enc)
-    resp = requests.post(
-        url=settings.WKHTMLTOPDF_URL,
-        data=json.dumps({'contents': data}),
-        headers={'Content-Type': 'application/json'}
+def mark_rendered(checks, file_name):
+    """
+    Set the rendered file of checks still new, each of them holds a reference to the file.
+    Checks rendered meanwhile by another task give their references back.
+    Returns the checks marked rendered
+    """
+    now = timezone.now()
+    pks = set(
+        Check.objects.select_for_update().filter(
+            pk__in=[check.pk for check in checks], status='new'
+        ).values_list('pk', flat=True)
+    )
+    Check.objects.filter(pk__in=pks).update(
+        status='rendered', pdf_file=file_name, lease_id=None, leased_until=None, updated_at=now
+    )
+    rendered = [check for check in checks if check.pk in pks]
+    if len(rendered) < len(checks):
+        render_cache.release([file_name] * (len(checks) - len(rendered)))
+        log.info(f'Checks {", ".join(str(check.pk) for check in checks if check.pk not in pks)} '
+                 f'are already rendered')
+    for check in rendered:
+        check.status = 'rendered'
+        check.pdf_file = file_name
+        check.lease_id = check.leased_until = None
+        check.updated_at = now
+    return rendered
+
+
+@shared_task
+def render_pending(backfill=False):
+    """
+    Task for rendering of new checks of several orders in batches of one renderer call.
+    Live checks and backfills are batched by runs of their own on their queues.
+    Checks of a batch are leased in a short transaction and rendered outside of it,
+    checks failing to render are sent to tasks of their own retried one by one
+    """
+    # checks of orders created from now on need a new run
+    cache.delete(render_pending_lock(backfill))
+    batch_size = settings.CHECKS_RENDER_BATCH_SIZE
+    while True:
+        checks = lease_pending(batch_size, backfill)
+        try:
+            rendered = render_checks(checks)
+        except (requests.RequestException, RenderError) as err:
+            log.error(err)
+            rendered = []
+        for check in rendered:
+            publish_rendered(check)
+        if len(rendered) < len(checks):
+            # one broken check must not hold back the others with retries of the whole batch
+            send_render_checks(
+                Check.objects.filter(
+                    pk__in=[check.pk for check in checks], status='new'
+                ).values_list('pk', 'check_type', 'backfill')
+            )
+        if len(checks) < batch_size:
+            return
+
+
+def lease_pending(batch_size, backfill=False):
+    """Lease a batch of new checks not leased by another run, kitchen checks first"""
+    now = timezone.now()
+    with transaction.atomic():
+        checks = list(
+            Check.objects.select_for_update(skip_locked=True).filter(
+                Q(leased_until__isnull=True) | Q(leased_until__lte=now),
+                status='new',
+                backfill=backfill
+            ).order_by(Case(When(check_type='kitchen', then=0), default=1), 'pk')[:batch_size]
+        )
+        # leased checks are not taken by the sweeper either, their updated_at is recent
+        Check.objects.filter(pk__in=[check.pk for check in checks]).update(
+            leased_until=now + timedelta(seconds=settings.CHECKS_RENDER_LEASE_TIMEOUT), updated_at=now
+        )
+    return checks
+
+
+def schedule_render_pending(backfill=False):
+    """Schedule one batch run per linger window, orders created meanwhile join the batch"""
+    linger = settings.CHECKS_RENDER_BATCH_LINGER
+    # the lock outlives a lost run, so it can't block scheduling for good.
+    # It is per process without a shared cache, concurrent runs are kept apart by leases
+    if cache.add(render_pending_lock(backfill), 1, timeout=linger + 60):
+        if backfill:
+            render_pending.apply_async(args=(True,), countdown=linger, queue=BACKFILL_QUEUE)
+        else:
+            render_pending.apply_async(countdown=linger)
+
+
+def render_pending_lock(backfill=False):
+    return f'{RENDER_PENDING_LOCK}:backfill' if backfill else RENDER_PENDING_LOCK
+
+
+def get_layout(check):
+    """Returns the address of the merchant point of the check and the output format of its printer"""
+    route = routing.get(check.order['merchant_point'])
+    if route is None:
+        raise ObjectDoesNotExist(f'Merchant point of check {check.pk} not found')
+    output_format = next(
+        (printer.output_format for printer in route.printers if printer.id == check.printer_id), 'pdf'
     )
-    resp.raise_for_status()
-    with open(settings.MEDIA_ROOT / file_name, 'wb') as f:
-        f.write(resp.content)
+    return route.address, output_format
+
+
+def render_content(check, address, output_format):
+    """Returns HTML of the check for PDF printers or ESC/POS bytes with the file extension"""
+    if output_format == 'escpos':
+        # Thermal printers take their own commands, so HTML and PDF are skipped
+        return render_escpos(check, address), 'bin'
+    html = render_to_string(
+        template_name='check.html',
+        context={'check': check, 'address': address}
+    )
+    return html, 'pdf'
+
+
+def render_checks(checks):
+    """
+    Render checks with PDFs missing in the render cache converted in one renderer call.
+    Files are written outside of transactions, returns the checks marked rendered
+    """
+    pending = {}
+    for check in checks:
+        try:
+            address, output_format = get_layout(check)
+            digest = render_cache.make_digest(check, address, output_format)
+        except Exception:
+            # left out of the batch to a task of its own, which fails with the error
+            log.exception(f'Check {check.pk} failed to render')
+            continue
+        pending.setdefault(digest, (address, output_format, []))[2].append(check)
+
+    rendered = []
+    missing = {}
+    with transaction.atomic():
+        for digest, (address, output_format, same_checks) in pending.items():
+            file_name = render_cache.acquire(digest, count=len(same_checks))
+            if file_name is None:
+                missing[digest] = (address, output_format, same_checks)
+            else:
+                rendered += mark_rendered(same_checks, file_name)
+    # only checks missing in the cache are rendered, once for all checks of the same digest
+    for digest, (address, output_format, same_checks) in list(missing.items()):
+        try:
+            content, extension = render_content(same_checks[0], address, output_format)
+        except Exception:
+            # left out of the batch to tasks of their own, which fail with the error
+            log.exception(f'Checks {", ".join(str(check.pk) for check in same_checks)} failed to render')
+            del missing[digest]
+            continue
+        missing[digest] = (content, extension, render_cache.make_name(digest, extension), same_checks)
+
+    documents = []
+    for content, extension, file_name, _ in missing.values():
+        if extension == 'bin':
+            save_file(content=content, file_name=file_name)
+        else:
+            documents.append((content, file_name))
+    if documents:
+        convert_many(documents)
+    sizes = {digest: default_storage.size(file_name) for digest, (_, _, file_name, _) in missing.items()}
+    with transaction.atomic():
+        for digest, (_, _, file_name, same_checks) in missing.items():
+            render_cache.store(digest, file_name, sizes[digest], count=len(same_checks))
+            rendered += mark_rendered(same_checks, file_name)
+    return rendered
+
+
+@shared_task
+def evict_render_cache():
+    """Task for eviction of unused rendered files over the cache size limit"""
+    return render_cache.evict(max_size=settings.CHECKS_RENDER_CACHE_MAX_SIZE)
+
+
+@shared_task
+def archive_printed_checks():
+    """Task for archiving of printed checks by retention policies of merchant points"""
+    # a run over a big backlog may outlast the beat interval
+    if not cache.add(ARCHIVE_LOCK, 1, timeout=settings.CHECKS_ARCHIVE_LOCK_TIMEOUT):
+        log.info('Archiving is already running')
+        return None
+    try:
+        return retention.archive_printed_checks()
+    finally:
+        cache.delete(ARCHIVE_LOCK)
+
+
+@shared_task
+def sweep_stuck_checks():
+    """Task for re-enqueue of checks stuck in new"""
+    # one sweep at a time. The lock is per process without a shared cache,
+    # skip_locked keeps concurrent sweeps from re-enqueueing a check twice
+    if not cache.add(SWEEP_LOCK, 1, timeout=settings.CHECKS_SWEEP_LOCK_TIMEOUT):
+        log.info('Sweep is already running')
+        return None
+    try:
+        return sweeper.sweep_stuck_checks()
+    finally:
+        cache.delete(SWEEP_LOCK)
+
+
+def convert_html_to_pdf(html, file_name):
+    """Convert HTML to PDF with the renderer configured in settings"""
+    with storage_path(file_name) as path:
+        get_renderer().render(html, path)
+
+
+def convert_many(documents):
+    """Convert (html, file_name) pairs to PDFs in one call of the renderer configured in settings"""
+    with ExitStack() as stack:
+        paths = [stack.enter_context(storage_path(file_name)) for _, file_name in documents]
+        get_renderer().render_many([(html, path) for (html, _), path in zip(documents, paths)])
+
+
+def save_file(content, file_name):
+    """Save already rendered content as is"""
+    default_storage.save(file_name, ContentFile(content))
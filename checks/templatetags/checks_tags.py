@@ -0,0 +1,36 @@
+import re
+
+from django import template
+from django.contrib.staticfiles import finders
+from django.utils.safestring import mark_safe
+
+register = template.Library()
+
+
+def minify_css(css):
+    """Strip comments and insignificant whitespace from CSS"""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.DOTALL)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{}:;,>])\s*', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+# Minified CSS by static path, filled once per process
+css_cache = {}
+
+
+def load_css(path):
+    """Returns minified content of a static CSS file, read once per process"""
+    if path not in css_cache:
+        file_path = finders.find(path)
+        if file_path is None:
+            raise template.TemplateSyntaxError(f'Static file {path} not found')
+        with open(file_path, encoding='utf-8') as f:
+            css_cache[path] = minify_css(f.read())
+    return css_cache[path]
+
+
+@register.simple_tag
+def inline_css(path):
+    """Inline a static CSS file, so rendering needs no network access"""
+    return mark_safe(load_css(path))
@@ -1,18 +1,65 @@
+import gzip
+import json
+import os
+import sys
+import time
 import uuid
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib import import_module
+from io import BytesIO, StringIO
 from pathlib import Path
 from tempfile import mkdtemp
-from unittest.mock import patch
+from threading import Thread, Timer
+from types import SimpleNamespace
+from unittest.mock import call, patch
 
 from _pytest.python_api import raises
+from asgiref.sync import sync_to_async
 from celery.exceptions import Retry
+from django.apps import apps
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection
+from django.template import TemplateSyntaxError
+from django.template.loader import render_to_string
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django_filters.compat import TestCase
-from requests import RequestException
+import redis
+from pypdf import PdfReader
+from requests import HTTPError, ReadTimeout, RequestException
 from rest_framework.reverse import reverse_lazy
 from rest_framework.test import APITestCase
 
-from checks.models import MerchantPoint, Printer, Check
-from checks.tasks import create_checks
+from checks import celery_app
+from checks.benchmarks import OrderGenerator, StubRenderer, compare_results, summarize
+from checks.cache import (
+    LRUCache, MISSING, PrinterKeyCache, RoutePrinter, RoutingTable, printer_keys, render_cache, routing
+)
+from checks.client import CircuitBreaker, CircuitOpenError, RendererClient, get_client, reset_client
+from checks.dispatch import Dispatcher
+from checks.escpos import FEED_AND_CUT, INIT
+from checks.events import publish_rendered, subscribe_printer
+from checks.models import MerchantPoint, Printer, Check, RenderedFile
+from checks.pool import RendererPool
+from checks.serializers import CheckItemSerializer
+from checks.storage import LocalStorage, S3Storage, storage_path
+from checks.renderers import (
+    PAGE_BREAK, LocalRenderer, PooledRenderer, RemoteRenderer, RenderError, SimpleRenderer, TextExtractor,
+    get_renderer
+)
+from checks.templatetags.checks_tags import css_cache, load_css, minify_css
+from checks.tasks import (
+    RENDER_PENDING_LOCK, SWEEP_LOCK, convert_html_to_pdf, create_checks, create_orders, mark_rendered,
+    render_check, render_content, render_pending, sweep_stuck_checks
+)
+from checks.views import error_event
 
 
 class TestTasks(TestCase):
@@ -20,7 +67,9 @@ class TestTasks(TestCase):
 
     def setUp(self):
         self.tmp_dir = Path(mkdtemp())
-        settings.MEDIA_ROOT = self.tmp_dir
+        media_root = override_settings(MEDIA_ROOT=self.tmp_dir)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
 
     def test_download(self):
         tmp_file = self.tmp_dir / 'test.txt'
@@ -40,6 +89,61 @@ class TestTasks(TestCase):
         resp = self.client.get(url_second)
         self.assertEqual(resp.status_code, 404)
 
+    def test_download_conditional(self):
+        name = render_cache.make_name('a' * 64)
+        (self.tmp_dir / name).parent.mkdir(parents=True)
+        (self.tmp_dir / name).write_bytes(b'%PDF')
+        url = reverse_lazy('media', args=[name])
+
+        resp = self.client.get(url)
+        self.assertEqual(resp['ETag'], f'"{"a" * 64}"')
+        self.assertIn('immutable', resp['Cache-Control'])
+
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self.client.get(url, HTTP_IF_MODIFIED_SINCE=resp['Last-Modified'])
+        self.assertEqual(resp.status_code, 304)
+
+    def test_download_range(self):
+        (self.tmp_dir / 'test.pdf').write_bytes(b'0123456789')
+        url = reverse_lazy('media', args=['test.pdf'])
+
+        resp = self.client.get(url, HTTP_RANGE='bytes=2-4')
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.getvalue(), b'234')
+        self.assertEqual(resp['Content-Range'], 'bytes 2-4/10')
+        self.assertEqual(resp['Cache-Control'], 'no-cache')
+
+        resp = self.client.get(url, HTTP_RANGE='bytes=-3')
+        self.assertEqual(resp.getvalue(), b'789')
+
+        resp = self.client.get(url, HTTP_RANGE='bytes=20-')
+        self.assertEqual(resp.status_code, 416)
+
+        resp = self.client.get(url, HTTP_RANGE='bytes=5-2')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.getvalue(), b'0123456789')
+
+        resp = self.client.get(url, HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.getvalue(), b'0123456789')
+
+    @override_settings(CHECKS_DOWNLOAD_ACCEL='x-accel-redirect')
+    def test_download_accel(self):
+        (self.tmp_dir / 'test.pdf').write_bytes(b'%PDF')
+
+        resp = self.client.get(reverse_lazy('media', args=['test.pdf']))
+        self.assertEqual(resp['X-Accel-Redirect'], '/protected-media/test.pdf')
+        self.assertEqual(resp.content, b'')
+
+    @override_settings(CHECKS_DOWNLOAD_ACCEL='x-sendfile')
+    def test_download_sendfile(self):
+        (self.tmp_dir / 'test.pdf').write_bytes(b'%PDF')
+
+        resp = self.client.get(reverse_lazy('media', args=['test.pdf']))
+        self.assertEqual(resp['X-Sendfile'], str(self.tmp_dir / 'test.pdf'))
+
 
 class TestAPI(APITestCase):
     """Base test class"""
@@ -215,6 +319,7 @@ class TestChecks(TestAPI):
     """Tests for checks"""
 
     def setUp(self):
+        routing.invalidate()
         self.check = Check.objects.get(pk=1)
 
     def test_list(self):
@@ -234,8 +339,24 @@ class TestChecks(TestAPI):
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(len(data), 2)
 
-    @patch('checks.tasks.create_checks.delay')
-    def test_create(self, mock_delay):
+        resp = self.client.get(f'{url}?order_uuid={self.check.order_uuid}')
+        data = resp.json()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(data), 2)
+
+    def test_backfill_order_uuid(self):
+        migration = import_module('checks.migrations.0002_check_order_uuid')
+        Check.objects.update(order_uuid=None)
+
+        migration.backfill_order_uuid(apps, None)
+
+        for check in Check.objects.all():
+            self.assertEqual(str(check.order_uuid), check.order['uuid'])
+
+    @override_settings(CHECKS_DISPATCH_WINDOW=0)
+    @patch('checks.dispatch.app.producer_or_acquire')
+    @patch('checks.tasks.create_orders.apply_async')
+    def test_create(self, mock_apply_async, mock_producer_or_acquire):
         url = reverse_lazy('check-list')
         data = {'order': {'merchant_point': 2, 'total_price': 20}}
 
@@ -250,13 +371,89 @@ class TestChecks(TestAPI):
 
         data['order']['merchant_point'] = 1
 
-        resp = self.client.post(path=url, data=data, format='json')
+        with self.captureOnCommitCallbacks(execute=True):
+            resp = self.client.post(path=url, data=data, format='json')
         order_uuid = resp.json()['uuid']
-        checks_len = len(Check.objects.filter(order__uuid=order_uuid))
+        checks_len = len(Check.objects.filter(order_uuid=order_uuid))
 
         self.assertEqual(resp.status_code, 201)
         self.assertTrue(order_uuid and len(order_uuid) > 16)
         self.assertEqual(checks_len, 3)
+        self.assertEqual(len(resp.json()['checks']), 3)
+        self.assertEqual(
+            {check['printer'] for check in resp.json()['checks']},
+            set(Printer.objects.filter(merchant_point=1).values_list('pk', flat=True))
+        )
+        # sent only after commit
+        mock_apply_async.assert_called_once_with(
+            ([order_uuid],), producer=mock_producer_or_acquire.return_value.__enter__.return_value
+        )
+
+    @patch('checks.views.dispatch_order')
+    def test_create_single_insert(self, mock_dispatch_order):
+        url = reverse_lazy('check-list')
+        data = {
+            'order': {
+                'merchant_point': 1,
+                'total_price': 20,
+                'items': [{'name': 'test', 'price': 10, 'count': 2}]
+            }
+        }
+        Printer.objects.bulk_create([
+            Printer(name=f'extra {i}', check_type='client', merchant_point_id=1)
+            for i in range(5)
+        ])
+        # bulk_create sends no signals
+        routing.invalidate()
+
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.post(path=url, data=data, format='json')
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT')]
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(len(resp.json()['checks']), 8)
+
+    @patch('checks.tasks.create_checks.chunks')
+    def test_create_batch(self, mock_chunks):
+        url = reverse_lazy('check-batch')
+        order = {
+            'merchant_point': 1,
+            'total_price': 20,
+            'items': [{'name': 'test', 'price': 10, 'count': 2}]
+        }
+        data = [
+            {'order': order},
+            {'order': {**order, 'merchant_point': 2}},
+            {'order': {'merchant_point': 1}},
+            {'order': order}
+        ]
+
+        resp = self.client.post(path=url, data={}, format='json')
+        self.assertEqual(resp.status_code, 400)
+
+        routing.get(1)
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.post(path=url, data=data, format='json')
+        selects = [q for q in queries.captured_queries if q['sql'].startswith('SELECT')]
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT')]
+        results = resp.json()['results']
+
+        self.assertEqual(resp.status_code, 207)
+        self.assertEqual(len(selects), 0)
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual([result['status'] for result in results], [201, 400, 400, 201])
+        self.assertTrue('No printers found' in results[1]['errors']['order'][0])
+        self.assertEqual(len(results[0]['checks']), 3)
+        for result in (results[0], results[3]):
+            self.assertEqual(
+                Check.objects.filter(order_uuid=result['order']['uuid'], backfill=True).count(), 3
+            )
+        mock_chunks.assert_called_once_with(
+            [(results[0]['order']['uuid'], True), (results[3]['order']['uuid'], True)],
+            settings.CHECKS_BATCH_CHUNK_SIZE
+        )
+        mock_chunks.return_value.apply_async.assert_called_once_with(queue='backfill')
 
     def test_retrieve(self):
         url = reverse_lazy('check-detail', args=[self.check.pk])
@@ -307,22 +504,1272 @@ class TestChecks(TestAPI):
         data = resp.json()
 
         self.assertEqual(resp.status_code, 200)
-        self.assertEqual(len(data), 1)
-        self.assertEqual(data[0]['id'], self.check.pk)
+        self.assertEqual(len(data['results']), 1)
+        self.assertEqual(data['results'][0]['id'], self.check.pk)
+        self.assertIsNone(data['next'])
 
         resp = self.client.get(url_second)
         self.assertEqual(resp.status_code, 404)
 
-    @patch('checks.tasks.convert_html_to_pdf')
-    @patch('checks.tasks.create_checks.retry')
-    def test_create_checks(self, mock_retry, mock_convert_html_to_pdf):
+    def test_get_for_print_pagination(self):
+        Check.objects.filter(printer_id=1).update(status='rendered')
+        api_key = Printer.objects.get(pk=1).api_key
+        url = reverse_lazy('check-for-print', args=[api_key])
+
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(f'{url}?page_size=1')
+        data = resp.json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(any('COUNT(' in q['sql'] for q in queries.captured_queries))
+        self.assertEqual([check['id'] for check in data['results']], [1])
+
+        resp = self.client.get(data['next'])
+        data = resp.json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([check['id'] for check in data['results']], [3])
+        self.assertIsNone(data['next'])
+
+    def test_claim_and_ack(self):
+        Check.objects.filter(printer_id=1).update(status='rendered')
+        api_key = Printer.objects.get(pk=1).api_key
+        url_claim = reverse_lazy('check-claim', args=[api_key])
+        url_ack = reverse_lazy('check-ack', args=[api_key])
+
+        resp = self.client.post(path=url_claim, data={'limit': 0}, format='json')
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.post(path=url_claim, data={'limit': 1}, format='json')
+        first = resp.json()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([check['id'] for check in first['results']], [1])
+
+        # leased checks are not claimable by another device
+        resp = self.client.post(path=url_claim, data={}, format='json')
+        second = resp.json()
+        self.assertEqual([check['id'] for check in second['results']], [3])
+
+        resp = self.client.post(path=url_claim, data={}, format='json')
+        self.assertEqual(resp.json()['results'], [])
+
+        # expired lease becomes claimable again and the old lease can not ack it
+        Check.objects.filter(pk=3).update(leased_until=timezone.now() - timedelta(seconds=1))
+        resp = self.client.post(path=url_claim, data={}, format='json')
+        third = resp.json()
+        self.assertEqual([check['id'] for check in third['results']], [3])
+
+        resp = self.client.post(path=url_ack, data={'lease': second['lease']}, format='json')
+        self.assertEqual(resp.json()['printed'], 0)
+
+        resp = self.client.post(path=url_ack, data={'lease': first['lease'], 'ids': [1]}, format='json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['printed'], 1)
+
+        resp = self.client.post(path=url_ack, data={'lease': third['lease']}, format='json')
+        self.assertEqual(resp.json()['printed'], 1)
+        self.assertEqual(
+            list(Check.objects.filter(status='printed').values_list('pk', flat=True).order_by('pk')),
+            [1, 3]
+        )
+
+        resp = self.client.post(path=reverse_lazy('check-ack', args=['test']), data={}, format='json')
+        self.assertEqual(resp.status_code, 404)
+
+    @patch('checks.tasks.group')
+    def test_create_checks(self, mock_group):
         create_checks(self.check.order['uuid'])
+
+        kitchen = render_check.s(1).set(queue='kitchen', priority=0)
+        mock_group.assert_called_once_with([kitchen, render_check.s(2).set(queue='client', priority=5)])
+        mock_group.return_value.apply_async.assert_called_once()
+
+        # kitchen checks first, rendered checks are skipped
+        Check.objects.filter(pk=3).update(check_type='client')
+        Check.objects.filter(pk=4).update(check_type='kitchen')
+        Check.objects.filter(pk=1).update(status='rendered')
+        create_checks(self.check.order['uuid'])
+        create_checks(Check.objects.get(pk=3).order['uuid'], backfill=True)
+
+        self.assertEqual(
+            mock_group.call_args_list[1].args[0], [render_check.s(2).set(queue='client', priority=5)]
+        )
+        self.assertEqual(mock_group.call_args_list[2].args[0], [
+            render_check.s(4).set(queue='backfill', priority=0),
+            render_check.s(3).set(queue='backfill', priority=5)
+        ])
+
+        with raises(ObjectDoesNotExist):
+            create_checks(str(uuid.uuid4()))
+
+    @patch('checks.dispatch.app.producer_or_acquire')
+    @patch('checks.tasks.create_orders.apply_async')
+    def test_dispatcher(self, mock_apply_async, mock_producer_or_acquire):
+        dispatcher = Dispatcher(window=60, max_orders=3)
+        dispatcher.add(['a'])
+        dispatcher.add(['b'])
+        self.assertFalse(mock_apply_async.called)
+
+        dispatcher.flush()
+        self.assertIsNone(dispatcher.timer)
+        mock_apply_async.assert_called_once()
+        self.assertEqual(mock_apply_async.call_args.args, ((['a', 'b'],),))
+
+        # a full batch is sent at once
+        dispatcher.add(['c', 'd', 'e', 'f'])
+        self.assertEqual(mock_apply_async.call_args_list[1].args, ((['c', 'd', 'e'],),))
+        self.assertEqual(mock_apply_async.call_args_list[2].args, ((['f'],),))
+        self.assertEqual(mock_producer_or_acquire.call_count, 2)
+
+    @patch('checks.dispatch.app.producer_or_acquire')
+    @patch('checks.tasks.create_orders.apply_async')
+    def test_dispatcher_failure(self, mock_apply_async, mock_producer_or_acquire):
+        error = OSError('broker down')
+        mock_apply_async.side_effect = [error, None, error, error]
+        dispatcher = Dispatcher(window=60, max_orders=3, retries=1, retry_delay=60)
+        dispatcher.add(['a'])
+        dispatcher.flush()
+
+        # the failed batch waits for a retry with orders added meanwhile
+        self.assertEqual(dispatcher.pending, ['a'])
+        self.assertEqual(dispatcher.timer.interval, 60)
+        dispatcher.add(['b'])
+        dispatcher.flush()
+        self.assertEqual(mock_apply_async.call_args.args, ((['a', 'b'],),))
+        self.assertEqual(dispatcher.failures, 0)
+
+        # out of retries the batch is left to the sweeper
+        dispatcher.add(['c'])
+        dispatcher.flush()
+        dispatcher.flush()
+        self.assertEqual(dispatcher.pending, [])
+        self.assertIsNone(dispatcher.timer)
+        self.assertEqual(mock_apply_async.call_count, 4)
+
+    def test_create_orders(self):
+        with patch('checks.tasks.group') as mock_group:
+            create_orders([self.check.order['uuid'], Check.objects.get(pk=3).order['uuid']])
+
+        self.assertEqual(len(mock_group.call_args.args[0]), 4)
+
+    def test_task_routes(self):
+        router = celery_app.amqp.router
+
+        self.assertEqual(router.route({}, 'checks.tasks.create_checks')['queue'].name, 'kitchen')
+        self.assertEqual(router.route({}, 'checks.tasks.evict_render_cache')['queue'].name, 'default')
+        self.assertEqual(
+            router.route({'queue': 'backfill'}, 'checks.tasks.create_checks')['queue'].name, 'backfill'
+        )
+
+    @patch('checks.tasks.default_storage.size', return_value=100)
+    @patch('checks.tasks.convert_html_to_pdf')
+    @patch('checks.tasks.render_check.retry')
+    def test_render_check(self, mock_retry, mock_convert_html_to_pdf, mock_size):
+        render_check(self.check.pk)
         check = Check.objects.get(pk=1)
 
         self.assertEqual(check.status, 'rendered')
-        self.assertTrue(check.order['uuid'] in check.pdf_file.name)
+        self.assertEqual(check.pdf_file.name, mock_convert_html_to_pdf.call_args.kwargs['file_name'])
+
+        render_check(self.check.pk)
+        self.assertEqual(mock_convert_html_to_pdf.call_count, 1)
 
         mock_retry.side_effect = Retry()
         mock_convert_html_to_pdf.side_effect = RequestException()
         with raises(Retry):
-            create_checks(check.order['uuid'])
+            render_check(2)
+        self.assertEqual(Check.objects.get(pk=2).status, 'new')
+        # the sweeper leaves a check waiting for its retry alone
+        self.assertGreater(
+            Check.objects.get(pk=2).leased_until,
+            timezone.now() + timedelta(seconds=render_check.default_retry_delay)
+        )
+
+
+class TestPrinterKeyCache(TestAPI):
+    """Tests for printer api key cache"""
+
+    def setUp(self):
+        printer_keys.clear()
+        self.printer = Printer.objects.get(pk=1)
+
+    def test_lru(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIs(cache.get('b'), MISSING)
+        self.assertEqual(cache.get('c'), 3)
+
+        cache = LRUCache(maxsize=2, ttl=0)
+        cache.set('a', 1)
+        self.assertIs(cache.get('a'), MISSING)
+
+    def test_resolve(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(printer_keys.resolve(self.printer.api_key), self.printer.pk)
+            self.assertEqual(printer_keys.resolve(self.printer.api_key), self.printer.pk)
+
+        with self.assertNumQueries(1):
+            self.assertIsNone(printer_keys.resolve('test'))
+            self.assertIsNone(printer_keys.resolve('test'))
+
+    def test_shared(self):
+        shared_cache = PrinterKeyCache(maxsize=10, ttl=60, alias='default')
+        with self.assertNumQueries(1):
+            shared_cache.resolve(self.printer.api_key)
+            shared_cache.local.clear()
+            self.assertEqual(shared_cache.resolve(self.printer.api_key), self.printer.pk)
+        shared_cache.invalidate(self.printer.api_key)
+
+    def test_invalidate(self):
+        old_api_key = self.printer.api_key
+        printer_keys.resolve(old_api_key)
+        printer_keys.resolve('test')
+
+        self.printer.api_key = 'test'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.printer.save()
+            self.assertEqual(printer_keys.resolve(old_api_key), self.printer.pk)
+
+        self.assertIsNone(printer_keys.resolve(old_api_key))
+        self.assertEqual(printer_keys.resolve('test'), self.printer.pk)
+
+        printer = Printer.objects.get(pk=3)
+        printer_keys.resolve(printer.api_key)
+        with self.captureOnCommitCallbacks(execute=True):
+            printer.delete()
+
+        self.assertIsNone(printer_keys.resolve(printer.api_key))
+
+    def test_ttl(self):
+        key_cache = PrinterKeyCache(maxsize=10, ttl=60, local_ttl=60, negative_ttl=0)
+        with self.assertNumQueries(3):
+            key_cache.resolve(self.printer.api_key)
+            key_cache.resolve(self.printer.api_key)
+            self.assertIsNone(key_cache.resolve('test'))
+            self.assertIsNone(key_cache.resolve('test'))
+
+        key_cache = PrinterKeyCache(maxsize=10, ttl=60, local_ttl=0)
+        with self.assertNumQueries(2):
+            key_cache.resolve(self.printer.api_key)
+            key_cache.resolve(self.printer.api_key)
+
+
+class TestRouting(TestAPI):
+    """Tests for merchant point routing table"""
+
+    def setUp(self):
+        routing.invalidate()
+
+    def test_get(self):
+        with self.assertNumQueries(2):
+            route = routing.get(1)
+            self.assertEqual(routing.get('1'), route)
+            self.assertIsNone(routing.get('test'))
+            self.assertIsNone(routing.get(100))
+
+        self.assertEqual(route.address, MerchantPoint.objects.get(pk=1).address)
+        self.assertEqual(
+            [printer.id for printer in route.printers],
+            list(Printer.objects.filter(merchant_point=1).values_list('pk', flat=True).order_by('pk'))
+        )
+        self.assertEqual(routing.get(2).printers, [])
+
+    def test_invalidate(self):
+        routing.get(1)
+        with self.captureOnCommitCallbacks(execute=True):
+            printer = Printer.objects.create(name='test', check_type='kitchen', merchant_point_id=2)
+            self.assertEqual(routing.get(2).printers, [])
+
+        self.assertEqual(routing.get(2).printers, [RoutePrinter(printer.pk, 'kitchen', 'pdf')])
+
+        merchant_point = MerchantPoint.objects.get(pk=2)
+        merchant_point.address = 'test'
+        with self.captureOnCommitCallbacks(execute=True):
+            merchant_point.save()
+
+        self.assertEqual(routing.get(2).address, 'test')
+
+    def test_ttl(self):
+        table = RoutingTable(alias=None, ttl=60)
+        with self.assertNumQueries(2):
+            table.get(1)
+            table.get(1)
+
+        table = RoutingTable(alias=None, ttl=0)
+        with self.assertNumQueries(4):
+            table.get(1)
+            table.get(1)
+
+        table = RoutingTable(alias='default', ttl=60)
+        table.get(1)
+        with self.assertNumQueries(2):
+            table.invalidate()
+            table.get(1)
+            table.get(1)
+
+    @patch('checks.views.dispatch_order')
+    def test_create_without_topology_queries(self, mock_dispatch_order):
+        url = reverse_lazy('check-list')
+        data = {
+            'order': {
+                'merchant_point': 1,
+                'total_price': 20,
+                'items': [{'name': 'test', 'price': 10, 'count': 2}]
+            }
+        }
+        routing.get(1)
+
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.post(path=url, data=data, format='json')
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertFalse(any(q['sql'].startswith('SELECT') for q in queries.captured_queries))
+
+
+@override_settings(CHECKS_EVENTS_BACKEND='checks.events.InMemoryEvents')
+class TestPrinterEvents(TestAPI):
+    """Tests for rendered check notifications"""
+
+    def setUp(self):
+        self.printer = Printer.objects.get(pk=1)
+        self.check = Check.objects.get(pk=1)
+
+    def test_publish(self):
+        with subscribe_printer(self.printer.pk) as subscription:
+            self.assertIsNone(subscription.get(timeout=0))
+            publish_rendered(self.check)
+            self.assertEqual(subscription.get(timeout=0), {'id': self.check.pk})
+
+    def test_long_poll(self):
+        url = reverse_lazy('check-for-print', args=[self.printer.api_key])
+
+        resp = self.client.get(f'{url}?wait=test')
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.get(f'{url}?wait=nan')
+        self.assertEqual(resp.status_code, 400)
+
+        timer = Timer(0.1, publish_rendered, args=[self.check])
+        timer.start()
+        started_at = time.monotonic()
+        resp = self.client.get(f'{url}?wait=5')
+        timer.join()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertLess(time.monotonic() - started_at, 5)
+
+        self.check.status = 'rendered'
+        self.check.save()
+        resp = self.client.get(f'{url}?wait=5')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['results'][0]['id'], self.check.pk)
+
+    def test_stream(self):
+        url = reverse_lazy('check-stream', args=[self.printer.api_key])
+
+        resp = self.client.get(reverse_lazy('check-stream', args=['test']))
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.get(url)
+        content = iter(resp.streaming_content)
+
+        self.assertEqual(resp['Content-Type'], 'text/event-stream')
+        self.assertEqual(next(content), b': connected\n\n')
+
+        self.check.status = 'rendered'
+        self.check.save()
+        publish_rendered(self.check)
+        event = next(content).decode()
+        resp.close()
+
+        self.assertTrue(event.startswith(f'id: {self.check.pk}\nevent: rendered\n'))
+        self.assertEqual(json.loads(event.split('data: ')[1])['id'], self.check.pk)
+
+    @patch('checks.views.subscribe_printer', side_effect=redis.RedisError('down'))
+    def test_events_down(self, mock_subscribe_printer):
+        self.check.status = 'rendered'
+        self.check.save()
+
+        # long-polls are answered without waiting
+        url = reverse_lazy('check-for-print', args=[self.printer.api_key])
+        resp = self.client.get(f'{url}?wait=5')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['results'][0]['id'], self.check.pk)
+
+        resp = self.client.get(reverse_lazy('check-stream', args=[self.printer.api_key]))
+        self.assertEqual(list(resp.streaming_content), [error_event('Events are unavailable').encode()])
+
+
+class StubRendererHandler(BaseHTTPRequestHandler):
+    """Handler of the stub wkhtmltopdf service"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        server.requests += 1
+        server.ports.add(self.client_address[1])
+        server.bodies.append(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(server.latency)
+        status_code = server.statuses.pop(0) if server.statuses else 200
+        body = b'%PDF-1.4 stub'
+        try:
+            self.send_response(status_code)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except ConnectionError:
+            # client gave up waiting
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_renderer():
+    """Start the stub wkhtmltopdf service in a thread"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubRendererHandler)
+    server.requests = 0
+    server.ports = set()
+    server.latency = 0
+    server.statuses = []
+    server.bodies = []
+    Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+    return server
+
+
+class TestRendererClient(TestCase):
+    """Tests for wkhtmltopdf service client against a local stub server"""
+
+    def setUp(self):
+        self.server = start_stub_renderer()
+        self.breaker = CircuitBreaker(threshold=3, reset_timeout=60)
+        self.client = RendererClient(
+            url=f'http://127.0.0.1:{self.server.server_port}',
+            connect_timeout=1,
+            read_timeout=0.2,
+            pool_size=2,
+            retries=2,
+            backoff=0.01,
+            backoff_max=0.02,
+            breaker=self.breaker
+        )
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for _ in range(5):
+            resp = self.client.post(data=b'test')
+            self.assertEqual(resp.content, b'%PDF-1.4 stub')
+
+        self.assertEqual(self.server.requests, 5)
+        self.assertEqual(len(self.server.ports), 1)
+
+    def test_retry(self):
+        self.server.statuses = [503, 502]
+        resp = self.client.post(data=b'test')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.breaker.failures, 0)
+
+        self.server.statuses = [400]
+        with raises(HTTPError):
+            self.client.post(data=b'test')
+        self.assertEqual(self.server.requests, 4)
+
+    def test_timeout(self):
+        self.server.latency = 0.3
+        self.client.retries = 0
+
+        with raises(ReadTimeout):
+            self.client.post(data=b'test')
+
+    def test_circuit_breaker(self):
+        self.server.statuses = [500] * 3
+        with raises(HTTPError):
+            self.client.post(data=b'test')
+
+        self.assertTrue(self.breaker.is_open)
+        with raises(CircuitOpenError):
+            self.client.post(data=b'test')
+        self.assertEqual(self.server.requests, 3)
+
+        self.breaker.reset_timeout = 0
+        resp = self.client.post(data=b'test')
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse(self.breaker.is_open)
+
+    def test_get_client(self):
+        client = get_client()
+        self.assertIs(get_client(), client)
+
+        reset_client()
+        self.assertIsNot(get_client(), client)
+
+
+class TestRenderers(TestCase):
+    """Tests for PDF renderer backends"""
+
+    def setUp(self):
+        self.html = render_to_string(
+            template_name='check.html',
+            context={
+                'check': {'check_type': 'kitchen', 'order': {
+                    'uuid': 'test', 'total_price': 10, 'items': [{'name': 'pizza', 'price': 10, 'count': 1}]
+                }},
+                'address': 'New York (Nine Street)'
+            }
+        )
+
+    def test_template(self):
+        self.assertNotIn('http', self.html)
+        self.assertIn('.table thead th{vertical-align:bottom;border-bottom:2px solid #dee2e6}', self.html)
+        self.assertNotIn('/*', self.html)
+        self.assertEqual(
+            minify_css('/* test */\n.a ,\n.b {\n    color: red;\n    margin: 0 auto;\n}\n'),
+            '.a,.b{color:red;margin:0 auto}'
+        )
+        self.assertEqual(css_cache['checks/receipt.css'], load_css('checks/receipt.css'))
+        with self.assertRaises(TemplateSyntaxError):
+            load_css('checks/test.css')
+
+    def render(self, renderer, html):
+        path = Path(mkdtemp()) / 'test.pdf'
+        renderer.render(html, path)
+        return path.read_bytes()
+
+    def test_simple(self):
+        pdf = self.render(SimpleRenderer(), self.html)
+
+        self.assertTrue(pdf.startswith(b'%PDF-1.4'))
+        self.assertTrue(pdf.rstrip().endswith(b'%%EOF'))
+        self.assertIn(b'(pizza 1 10) Tj', pdf)
+        self.assertIn(b'New York \\(Nine Street\\)', pdf)
+        self.assertNotIn(b'@page', pdf)
+
+    def test_local(self):
+        self.assertEqual(self.render(LocalRenderer(binary='cat', options=[]), self.html), self.html.encode())
+
+        with raises(RenderError):
+            self.render(LocalRenderer(binary='false', options=[]), self.html)
+        with raises(RenderError):
+            self.render(LocalRenderer(binary='/nonexistent/wkhtmltopdf'), self.html)
+
+    def test_remote(self):
+        server = start_stub_renderer()
+        try:
+            with override_settings(WKHTMLTOPDF_URL=f'http://127.0.0.1:{server.server_port}'):
+                reset_client()
+                pdf = self.render(RemoteRenderer(), self.html)
+            reset_client()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(pdf, b'%PDF-1.4 stub')
+        self.assertIn(b'name="file"; filename="check.html"', server.bodies[0])
+        self.assertIn(self.html.encode(), server.bodies[0])
+
+    @override_settings(CHECKS_RENDERER='checks.renderers.SimpleRenderer', MEDIA_ROOT=Path(mkdtemp()))
+    def test_convert_html_to_pdf(self):
+        self.assertIsInstance(get_renderer(), SimpleRenderer)
+
+        convert_html_to_pdf(self.html, 'test.pdf')
+
+        with open(settings.MEDIA_ROOT / 'test.pdf', 'rb') as f:
+            self.assertTrue(f.read().startswith(b'%PDF'))
+
+        with patch.object(SimpleRenderer, 'build_pdf', side_effect=RenderError):
+            with raises(RenderError):
+                convert_html_to_pdf(self.html, 'test2.pdf')
+        self.assertEqual(os.listdir(settings.MEDIA_ROOT), ['test.pdf'])
+
+
+STUB_WKHTMLTOPDF = """#!{executable}
+import os
+import shlex
+import sys
+
+assert sys.argv[1:] == ['--read-args-from-stdin']
+for line in sys.stdin:
+    args = shlex.split(line)
+    with open(args[-2]) as f:
+        html = f.read()
+    if 'fail' in html:
+        sys.stderr.write('Exit with code 1 due to network error: HostNotFoundError\\nFailed\\n')
+    else:
+        with open(args[-1], 'wb') as f:
+            f.write(b'%PDF ' + str(os.getpid()).encode())
+        sys.stderr.write('Loading pages (1/6)\\n[====>   ] 50%\\r[========] 100%\\nDone\\n')
+    sys.stderr.flush()
+"""
+
+
+class TestRendererPool(TestCase):
+    """Tests for pool of warm renderer processes against a stub wkhtmltopdf"""
+
+    def setUp(self):
+        self.binary = Path(mkdtemp()) / 'wkhtmltopdf'
+        self.binary.write_text(STUB_WKHTMLTOPDF.format(executable=sys.executable))
+        self.binary.chmod(0o755)
+        self.pool = RendererPool(
+            size=1,
+            binary=str(self.binary),
+            options=['--quiet', '--encoding', 'utf-8'],
+            timeout=5,
+            max_jobs=3,
+            max_memory=0
+        )
+
+    def tearDown(self):
+        self.pool.close()
+
+    def render(self, renderer, html):
+        path = self.binary.parent / 'test.pdf'
+        renderer.render(html, path)
+        return path.read_bytes()
+
+    def test_render(self):
+        pdfs = [self.render(self.pool, 'test') for _ in range(3)]
+
+        self.assertTrue(all(pdf.startswith(b'%PDF') for pdf in pdfs))
+        self.assertEqual(len(set(pdfs)), 1)
+        # recycled after max_jobs
+        self.assertNotEqual(self.render(self.pool, 'test'), pdfs[0])
+        self.assertEqual(os.listdir(self.pool.workdir), [])
+
+    def test_failure(self):
+        pdf = self.render(self.pool, 'test')
+
+        with raises(RenderError):
+            self.render(self.pool, 'fail')
+        self.assertNotEqual(self.render(self.pool, 'test'), pdf)
+        self.assertEqual(len(self.pool.processes), 1)
+
+    def test_pooled_renderer(self):
+        with override_settings(WKHTMLTOPDF_BINARY=str(self.binary)):
+            renderer = PooledRenderer()
+            pdf = self.render(renderer, 'test')
+            self.assertEqual(self.render(renderer, 'test'), pdf)
+            renderer.stop()
+        self.assertIsNone(renderer.pool)
+
+    def test_bench_renderer(self):
+        out = StringIO()
+        with override_settings(WKHTMLTOPDF_BINARY=str(self.binary)):
+            call_command(
+                'bench_renderer', count=2, renderers=['checks.renderers.PooledRenderer'], stdout=out
+            )
+        self.assertIn('renders/s per core', out.getvalue())
+
+
+@override_settings(CHECKS_RENDERER='checks.renderers.SimpleRenderer', MEDIA_ROOT=Path(mkdtemp()))
+class TestRenderCache(TestAPI):
+    """Tests for content-addressed render cache"""
+
+    def setUp(self):
+        # counters are shared by workers through the cache
+        alias = patch.object(render_cache, 'alias', 'default')
+        alias.start()
+        self.addCleanup(alias.stop)
+        render_cache.reset_stats()
+
+    @patch('checks.tasks.convert_html_to_pdf', wraps=convert_html_to_pdf)
+    def test_render_check(self, mock_convert_html_to_pdf):
+        # a check of another order with the same items
+        same_check = Check.objects.get(pk=2)
+        same_check.pk = None
+        same_check.printer_id = 3
+        same_check.order_uuid = uuid.uuid4()
+        same_check.order = {**same_check.order, 'uuid': str(same_check.order_uuid)}
+        same_check.save()
+
+        render_check(2)
+        render_check(same_check.pk)
+
+        first, second = Check.objects.get(pk=2), Check.objects.get(pk=same_check.pk)
+        self.assertEqual(mock_convert_html_to_pdf.call_count, 1)
+        self.assertEqual(first.pdf_file.name, second.pdf_file.name)
+        self.assertTrue((settings.MEDIA_ROOT / first.pdf_file.name).exists())
+
+        rendered_file = RenderedFile.objects.get()
+        self.assertEqual(rendered_file.ref_count, 2)
+        self.assertEqual(render_cache.get_stats()['hit_rate'], 0.5)
+
+        first.delete()
+        rendered_file.refresh_from_db()
+        self.assertEqual(rendered_file.ref_count, 1)
+
+    def test_mark_rendered(self):
+        render_check(2)
+        check = Check.objects.get(pk=2)
+
+        # a re-sent task of the check renders it once more
+        file_name = render_cache.acquire(render_cache.parse_digest(check.pdf_file.name))
+        self.assertEqual(mark_rendered([check], file_name), [])
+        self.assertEqual(RenderedFile.objects.get().ref_count, 1)
+
+    def test_evict(self):
+        for digest, ref_count in (('a' * 64, 0), ('b' * 64, 1), ('c' * 64, 0)):
+            name = render_cache.make_name(digest)
+            default_storage.save(name, ContentFile(b'%PDF'))
+            RenderedFile.objects.create(digest=digest, file=name, size=4, ref_count=ref_count)
+
+        self.assertEqual(render_cache.evict(max_size=8), 1)
+        self.assertEqual(
+            list(RenderedFile.objects.order_by('digest').values_list('digest', flat=True)),
+            ['b' * 64, 'c' * 64]
+        )
+        self.assertFalse(default_storage.exists(render_cache.make_name('a' * 64)))
+
+        # referenced files are never evicted
+        self.assertEqual(render_cache.evict(max_size=0), 1)
+        self.assertEqual(RenderedFile.objects.get().digest, 'b' * 64)
+
+    def test_stats_command(self):
+        render_cache.count(render_cache.hits_key)
+        out = StringIO()
+        call_command('render_cache_stats', reset=True, stdout=out)
+
+        self.assertEqual(json.loads(out.getvalue())['hits'], 1)
+        self.assertEqual(render_cache.get_stats()['hits'], 0)
+
+        # per process counters would always read 0 in the command
+        with patch.object(render_cache, 'alias', None):
+            render_cache.count(render_cache.hits_key)
+            self.assertIsNone(render_cache.get_stats()['hit_rate'])
+
+
+@override_settings(MEDIA_ROOT=Path(mkdtemp()))
+class TestEscPos(TestAPI):
+    """Tests for native ESC/POS output of thermal printers"""
+
+    def setUp(self):
+        Printer.objects.filter(pk=2).update(output_format='escpos')
+        routing.invalidate()
+
+    @patch('checks.tasks.convert_html_to_pdf')
+    def test_render_check(self, mock_convert_html_to_pdf):
+        render_check(2)
+
+        check = Check.objects.get(pk=2)
+        self.assertFalse(mock_convert_html_to_pdf.called)
+        self.assertEqual(check.status, 'rendered')
+        self.assertTrue(check.pdf_file.name.endswith('.bin'))
+
+        resp = self.client.get(reverse_lazy('media', args=[check.pdf_file.name]))
+        content = resp.getvalue()
+        self.assertEqual(resp['Content-Type'], 'application/octet-stream')
+        self.assertTrue(content.startswith(INIT))
+        self.assertTrue(content.endswith(FEED_AND_CUT))
+        self.assertIn(b'TOTAL', content)
+        self.assertLess(len(content), 1024)
+
+
+class BatchSimpleRenderer(SimpleRenderer):
+    """Simple renderer joining batches, starts a new page on page breaks"""
+    batch = True
+
+    def render(self, html, path):
+        pages = []
+        for part in html.split(PAGE_BREAK):
+            extractor = TextExtractor()
+            extractor.feed(part)
+            pages.append([line for line in extractor.lines if line])
+        with open(path, 'wb') as f:
+            f.write(self.build_pdf(pages))
+
+
+@override_settings(
+    CHECKS_RENDERER='checks.tests.BatchSimpleRenderer',
+    CHECKS_RENDER_BATCH_SIZE=10,
+    MEDIA_ROOT=Path(mkdtemp())
+)
+class TestRenderBatch(TestAPI):
+    """Tests for batch rendering of several orders in one renderer call"""
+
+    def setUp(self):
+        cache.delete_many([RENDER_PENDING_LOCK, f'{RENDER_PENDING_LOCK}:backfill'])
+        routing.invalidate()
+
+    def test_render_many(self):
+        documents = [
+            (
+                f'<html><head></head><body><p>check {number}</p></body></html>',
+                settings.MEDIA_ROOT / f'{number}.pdf'
+            )
+            for number in range(3)
+        ]
+        with patch.object(BatchSimpleRenderer, 'render', autospec=True,
+                          side_effect=BatchSimpleRenderer.render) as mock_render:
+            BatchSimpleRenderer().render_many(documents)
+
+        self.assertEqual(mock_render.call_count, 1)
+        for number, (_, path) in enumerate(documents):
+            pages = PdfReader(path).pages
+            self.assertEqual(len(pages), 1)
+            self.assertIn(f'check {number}', pages[0].extract_text())
+
+    @patch('checks.tasks.render_pending.apply_async')
+    def test_create_checks(self, mock_apply_async):
+        for order_uuid in set(Check.objects.values_list('order_uuid', flat=True)):
+            create_checks(order_uuid)
+            create_checks(order_uuid, backfill=True)
+
+        # backfills are batched by a run of their own on their queue
+        self.assertEqual(mock_apply_async.call_args_list, [
+            call(countdown=settings.CHECKS_RENDER_BATCH_LINGER),
+            call(args=(True,), countdown=settings.CHECKS_RENDER_BATCH_LINGER, queue='backfill')
+        ])
+
+    def test_render_pending_backfill(self):
+        Check.objects.filter(pk__in=[3, 4]).update(backfill=True)
+        render_pending()
+        self.assertEqual(sorted(Check.objects.filter(status='new').values_list('pk', flat=True)), [3, 4])
+
+        render_pending(backfill=True)
+        self.assertFalse(Check.objects.filter(status='new').exists())
+
+    def test_render_pending(self):
+        with patch.object(BatchSimpleRenderer, 'render', autospec=True,
+                          side_effect=BatchSimpleRenderer.render) as mock_render:
+            render_pending()
+
+        self.assertEqual(mock_render.call_count, 1)
+        self.assertFalse(Check.objects.exclude(status='rendered').exists())
+        for check in Check.objects.all():
+            text = PdfReader(settings.MEDIA_ROOT / check.pdf_file.name).pages[0].extract_text()
+            self.assertIn(str(check.order['total_price']), text)
+        self.assertFalse(Check.objects.filter(leased_until__isnull=False).exists())
+
+    @patch('checks.tasks.group')
+    @patch('checks.tasks.convert_many', side_effect=RenderError('failed'))
+    def test_render_pending_failure(self, mock_convert_many, mock_group):
+        leased = Check.objects.get(pk=1)
+        leased.leased_until = timezone.now() + timedelta(minutes=1)
+        leased.save()
+        render_pending()
+
+        # checks of the failed batch are retried on their own, kitchen checks first
+        pending = Check.objects.exclude(pk=leased.pk).order_by('-check_type', 'pk')
+        sent = mock_group.call_args.args[0]
+        self.assertEqual([task.args[0] for task in sent], [check.pk for check in pending])
+        self.assertEqual(sent[0].options['queue'], 'kitchen')
+        self.assertFalse(Check.objects.exclude(status='new').exists())
+        self.assertFalse(RenderedFile.objects.exists())
+
+    @patch('checks.tasks.group')
+    def test_render_pending_broken_check(self, mock_group):
+        def broken_content(check, address, output_format):
+            if check.pk == 1:
+                raise TemplateSyntaxError('broken')
+            return render_content(check, address, output_format)
+
+        with patch('checks.tasks.render_content', side_effect=broken_content):
+            render_pending()
+
+        # the broken check is left to a task of its own, the rest of the batch is rendered
+        self.assertEqual([task.args[0] for task in mock_group.call_args.args[0]], [1])
+        self.assertEqual(list(Check.objects.filter(status='new').values_list('pk', flat=True)), [1])
+
+
+class FakeClientError(Exception):
+    """Stand-in of botocore ClientError"""
+
+    def __init__(self, response):
+        super().__init__(response)
+        self.response = response
+
+
+class FakeS3Client:
+    """In-memory stand-in of a boto3 S3 client"""
+    exceptions = SimpleNamespace(ClientError=FakeClientError)
+
+    def __init__(self):
+        self.objects = {}
+        self.gets = 0
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None):
+        self.objects[(Bucket, Key)] = (Fileobj.read(), (ExtraArgs or {}).get('Metadata', {}), timezone.now())
+
+    def get_object(self, Bucket, Key):
+        self.gets += 1
+        return {'Body': BytesIO(self.objects[(Bucket, Key)][0])}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise FakeClientError({'Error': {'Code': '404'}})
+        body, metadata, modified_at = self.objects[(Bucket, Key)]
+        return {'ContentLength': len(body), 'Metadata': metadata, 'LastModified': modified_at}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+
+class TestStorage(TestCase):
+    """Tests for storages of rendered files"""
+    content = b'%PDF' * 100
+
+    def test_compressed_local_storage(self):
+        storage = LocalStorage(location=mkdtemp(), compress=True)
+        name = storage.save('cas/aa/test.pdf', ContentFile(self.content))
+
+        self.assertEqual(name, 'cas/aa/test.pdf')
+        with open(storage.path(name), 'rb') as f:
+            self.assertEqual(f.read(2), b'\x1f\x8b')
+        with storage.open(name) as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(storage.size(name), len(self.content))
+        self.assertEqual(os.listdir(storage.path('cas/aa')), ['test.pdf'])
+
+    def test_local_storage_replaces_files(self):
+        storage = LocalStorage(location=mkdtemp())
+        self.assertEqual(storage.save('cas/aa/test.pdf', ContentFile(b'old')), 'cas/aa/test.pdf')
+        self.assertEqual(storage.save('cas/aa/test.pdf', ContentFile(self.content)), 'cas/aa/test.pdf')
+
+        self.assertEqual(os.listdir(storage.path('cas/aa')), ['test.pdf'])
+        with storage.open('cas/aa/test.pdf') as f:
+            self.assertEqual(f.read(), self.content)
+
+        with storage_path('cas/aa/test.pdf', storage) as path:
+            Path(path).write_bytes(b'new')
+        self.assertEqual(os.listdir(storage.path('cas/aa')), ['test.pdf'])
+        self.assertEqual(os.stat(storage.path('cas/aa/test.pdf')).st_mode & 0o777, 0o644)
+
+    def test_s3_storage(self):
+        client = FakeS3Client()
+        storage = S3Storage(bucket='checks', prefix='media', compress=True, client=client)
+        name = storage.save('cas/aa/test.pdf', ContentFile(self.content))
+
+        self.assertIn(('checks', 'media/cas/aa/test.pdf'), client.objects)
+        self.assertTrue(storage.exists(name))
+        self.assertFalse(storage.exists('cas/aa/test'))
+        self.assertEqual(storage.open(name).read(), self.content)
+        self.assertEqual(client.gets, 1)
+        self.assertEqual(storage.size(name), len(self.content))
+        self.assertEqual(client.gets, 1)
+
+        # large objects are spooled to disk instead of memory
+        storage.spool_size = 100
+        with storage.open(name) as f:
+            self.assertTrue(f.file._rolled)
+            f.seek(4)
+            self.assertEqual(f.read(4), b'%PDF')
+
+        error = FakeClientError({'Error': {'Code': '403'}})
+        with patch.object(client, 'head_object', side_effect=error), self.assertRaises(FakeClientError):
+            storage.exists(name)
+
+        storage.delete(name)
+        self.assertFalse(storage.exists(name))
+
+    def test_download_from_s3(self):
+        client = FakeS3Client()
+        storages = {
+            'default': {
+                'BACKEND': 'checks.storage.S3Storage',
+                'OPTIONS': {'bucket': 'checks', 'client': client}
+            }
+        }
+        with override_settings(STORAGES=storages):
+            default_storage.save('test.pdf', ContentFile(self.content))
+            resp = self.client.get(reverse_lazy('media', args=['test.pdf']), HTTP_RANGE='bytes=0-3')
+
+            self.assertEqual(resp.status_code, 206)
+            self.assertEqual(resp.getvalue(), b'%PDF')
+
+            # objects have no local path for the proxy
+            with override_settings(CHECKS_DOWNLOAD_ACCEL='x-sendfile'):
+                resp = self.client.get(reverse_lazy('media', args=['test.pdf']))
+            self.assertNotIn('X-Sendfile', resp)
+            self.assertEqual(resp.getvalue(), self.content)
+
+
+@override_settings(MEDIA_ROOT=Path(mkdtemp()))
+class TestMigrateFiles(TestAPI):
+    """Tests for moving flat files of checks into the content-addressed storage"""
+
+    def test_migrate_files(self):
+        for pk in (1, 2):
+            name = f'{pk}_check.pdf'
+            (settings.MEDIA_ROOT / name).write_bytes(b'%PDF')
+            Check.objects.filter(pk=pk).update(pdf_file=name)
+
+        out = StringIO()
+        call_command('migrate_files', batch_size=1, stdout=out)
+
+        self.assertIn('moved 2 files', out.getvalue())
+        first, second = Check.objects.get(pk=1), Check.objects.get(pk=2)
+        self.assertEqual(first.pdf_file.name, second.pdf_file.name)
+        self.assertTrue(first.pdf_file.name.startswith('cas/'))
+        self.assertTrue(default_storage.exists(first.pdf_file.name))
+        self.assertFalse((settings.MEDIA_ROOT / '1_check.pdf').exists())
+        self.assertEqual(RenderedFile.objects.get().ref_count, 2)
+
+
+@override_settings(MEDIA_ROOT=Path(mkdtemp()))
+class TestRetention(TestAPI):
+    """Tests for archiving of printed checks"""
+
+    def setUp(self):
+        cached_name = render_cache.make_name('a' * 64)
+        default_storage.save(cached_name, ContentFile(b'%PDF'))
+        RenderedFile.objects.create(digest='a' * 64, file=cached_name, size=4, ref_count=1)
+        default_storage.save('2_check.pdf', ContentFile(b'%PDF'))
+        Check.objects.filter(pk=1).update(pdf_file=cached_name)
+        Check.objects.filter(pk=2).update(pdf_file='2_check.pdf')
+        Check.objects.filter(pk__in=[1, 2, 3]).update(status='printed')
+        Check.objects.filter(pk__in=[1, 2]).update(created_at=timezone.now() - timedelta(days=40))
+        Check.objects.filter(pk=3).update(created_at=timezone.now())
+
+    def test_retention_policy(self):
+        MerchantPoint.objects.filter(pk=1).update(retention_days=100)
+        call_command('archive_checks', stdout=StringIO())
+
+        self.assertEqual(Check.objects.count(), 4)
+
+    def test_archive_checks(self):
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('archive_checks', batch_size=1, stdout=out)
+
+        self.assertEqual(json.loads(out.getvalue()), {'1': 2, '2': 0})
+        self.assertEqual(sorted(Check.objects.values_list('pk', flat=True)), [3, 4])
+        self.assertEqual(RenderedFile.objects.get().ref_count, 0)
+        self.assertFalse(default_storage.exists('2_check.pdf'))
+
+        _, names = default_storage.listdir('archive/1')
+        rows = []
+        for name in sorted(names):
+            with default_storage.open(f'archive/1/{name}') as f:
+                rows.extend(json.loads(line) for line in gzip.decompress(f.read()).splitlines())
+        self.assertEqual([row['id'] for row in rows], [1, 2])
+        self.assertEqual(rows[1]['order_uuid'], rows[1]['order']['uuid'])
+
+    def test_archive_releases_batch(self):
+        Check.objects.filter(pk=2).update(pdf_file=render_cache.make_name('a' * 64))
+        RenderedFile.objects.update(ref_count=2)
+        with CaptureQueriesContext(connection) as queries:
+            call_command('archive_checks', stdout=StringIO())
+
+        updates = [q for q in queries.captured_queries if q['sql'].startswith('UPDATE "checks_renderedfile"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(RenderedFile.objects.get().ref_count, 0)
+        self.assertEqual(sorted(Check.objects.values_list('pk', flat=True)), [3, 4])
+
+
+class TestSweeper(TestAPI):
+    """Tests for re-enqueue of checks stuck in new"""
+
+    def setUp(self):
+        cache.delete(SWEEP_LOCK)
+        long_ago = timezone.now() - timedelta(hours=1)
+        Check.objects.update(created_at=long_ago, updated_at=long_ago)
+        Check.objects.filter(pk=2).update(status='rendered')
+        Check.objects.filter(pk=3).update(backfill=True)
+        Check.objects.filter(pk=4).update(render_attempts=3)
+
+    @patch('checks.tasks.group')
+    def test_sweep_checks(self, mock_group):
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('sweep_checks', batch_size=1, max_attempts=3, stdout=out)
+
+        self.assertEqual(json.loads(out.getvalue()), {'requeued': 2, 'failed': 1})
+        self.assertEqual(
+            [call.args[0] for call in mock_group.call_args_list],
+            [
+                [render_check.s(1).set(queue='kitchen', priority=0)],
+                [render_check.s(3).set(queue='backfill', priority=0)]
+            ]
+        )
+        self.assertEqual(
+            list(Check.objects.order_by('pk').values_list('status', 'render_attempts')),
+            [('new', 1), ('rendered', 0), ('new', 1), ('failed', 3)]
+        )
+        self.assertGreater(
+            Check.objects.get(pk=3).leased_until - Check.objects.get(pk=1).leased_until,
+            timedelta(minutes=30)
+        )
+
+        # re-enqueued checks get a new period
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('sweep_checks', stdout=out)
+        self.assertEqual(mock_group.call_count, 2)
+
+    @patch('checks.tasks.group')
+    def test_sweep_leased_checks(self, mock_group):
+        Check.objects.filter(pk=1).update(leased_until=timezone.now() + timedelta(minutes=1))
+
+        # a check with a task in flight is not sent once more
+        self.assertEqual(sweep_stuck_checks(), {'requeued': 1, 'failed': 1})
+        self.assertEqual(Check.objects.get(pk=1).render_attempts, 0)
+
+        Check.objects.filter(pk=1).update(leased_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(sweep_stuck_checks(), {'requeued': 1, 'failed': 0})
+        self.assertEqual(Check.objects.get(pk=1).render_attempts, 1)
+
+    @patch('checks.sweeper.sweep_stuck_checks')
+    def test_sweep_lock(self, mock_sweep_stuck_checks):
+        cache.add(SWEEP_LOCK, 1)
+
+        self.assertIsNone(sweep_stuck_checks())
+        self.assertFalse(mock_sweep_stuck_checks.called)
+
+
+@override_settings(ROOT_URLCONF='gen_checks.asgi_urls', MEDIA_ROOT=Path(mkdtemp()))
+class TestAsyncViews(TestAPI):
+    """Tests for async views of hot endpoints"""
+
+    def setUp(self):
+        self.printer = Printer.objects.get(pk=1)
+        self.check = Check.objects.get(pk=1)
+
+    @patch('checks.async_views.dispatch_order')
+    async def test_create(self, mock_dispatch_order):
+        url = reverse_lazy('check-list')
+        data = {'order': {'merchant_point': 1, 'total_price': 20}}
+
+        resp = await self.async_client.post(url, data=data, content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+
+        data['order']['items'] = [{'name': 'test', 'price': 10, 'count': 2}]
+        resp = await self.async_client.post(url, data=data, content_type='application/json')
+        order_uuid = resp.json()['uuid']
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(len(resp.json()['checks']), 3)
+        self.assertEqual(await Check.objects.filter(order_uuid=order_uuid).acount(), 3)
+        mock_dispatch_order.assert_called_once_with(order_uuid)
+
+        # the same response as the sync view
+        with patch('checks.views.dispatch_order'), override_settings(ROOT_URLCONF='gen_checks.urls'):
+            sync_resp = await sync_to_async(self.client.post)(url, data=data, format='json')
+        self.assertEqual(sync_resp.json().keys(), resp.json().keys())
+        self.assertEqual(sync_resp.json()['checks'][0].keys(), resp.json()['checks'][0].keys())
+
+        resp = await self.async_client.get(url)
+        self.assertEqual(resp.status_code, 200)
+
+    async def test_for_print(self):
+        url = reverse_lazy('check-for-print', args=[self.printer.api_key])
+
+        resp = await self.async_client.get(f'{url}?wait=test')
+        self.assertEqual(resp.status_code, 400)
+
+        resp = await self.async_client.get(f'{url}?wait=inf')
+        self.assertEqual(resp.status_code, 400)
+
+        resp = await self.async_client.get(reverse_lazy('check-for-print', args=['test']))
+        self.assertEqual(resp.status_code, 404)
+
+        timer = Timer(0.1, publish_rendered, args=[self.check])
+        timer.start()
+        started_at = time.monotonic()
+        resp = await self.async_client.get(f'{url}?wait=5')
+        timer.join()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertLess(time.monotonic() - started_at, 5)
+        self.assertEqual(resp.json()['results'], [])
+
+        await Check.objects.filter(pk=self.check.pk).aupdate(status='rendered')
+        resp = await self.async_client.get(f'{url}?wait=5')
+        self.assertEqual(resp.json()['results'][0]['id'], self.check.pk)
+
+    async def test_stream(self):
+        url = reverse_lazy('check-stream', args=[self.printer.api_key])
+
+        resp = await self.async_client.get(reverse_lazy('check-stream', args=['test']))
+        self.assertEqual(resp.status_code, 404)
+
+        resp = await self.async_client.get(url)
+        content = resp.streaming_content
+
+        self.assertTrue(resp.is_async)
+        self.assertEqual(resp['Content-Type'], 'text/event-stream')
+        self.assertEqual(await anext(content), b': connected\n\n')
+
+        await Check.objects.filter(pk=self.check.pk).aupdate(status='rendered')
+        publish_rendered(self.check)
+        event = (await anext(content)).decode()
+        await content.aclose()
+
+        self.assertTrue(event.startswith(f'id: {self.check.pk}\nevent: rendered\n'))
+        self.assertEqual(json.loads(event.split('data: ')[1])['id'], self.check.pk)
+
+    @patch('checks.async_views.asubscribe_printer', side_effect=redis.RedisError('down'))
+    async def test_events_down(self, mock_asubscribe_printer):
+        await Check.objects.filter(pk=self.check.pk).aupdate(status='rendered')
+
+        url = reverse_lazy('check-for-print', args=[self.printer.api_key])
+        resp = await self.async_client.get(f'{url}?wait=5')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()['results'][0]['id'], self.check.pk)
+
+        resp = await self.async_client.get(reverse_lazy('check-stream', args=[self.printer.api_key]))
+        content = [chunk async for chunk in resp.streaming_content]
+        self.assertEqual(content, [error_event('Events are unavailable').encode()])
+
+    async def test_download(self):
+        (settings.MEDIA_ROOT / 'test.pdf').write_bytes(b'0123456789')
+        url = reverse_lazy('media', args=['test.pdf'])
+
+        resp = await self.async_client.get(url)
+        self.assertEqual(b''.join([chunk async for chunk in resp.streaming_content]), b'0123456789')
+        self.assertEqual(resp['Content-Disposition'], 'inline; filename="test.pdf"')
+
+        resp = await self.async_client.get(url, headers={'Range': 'bytes=2-4'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(b''.join([chunk async for chunk in resp.streaming_content]), b'234')
+
+
+class TestBenchmarks(TestAPI):
+    """Tests for parts of the offline benchmark suite"""
+
+    def test_stub_renderer(self):
+        tmp_dir = Path(mkdtemp())
+        with StubRenderer(latency=0) as stub, override_settings(WKHTMLTOPDF_URL=stub.url):
+            reset_client()
+            try:
+                RemoteRenderer().render_many([
+                    ('<html><body>first</body></html>', tmp_dir / 'first.pdf'),
+                    ('<html><body>second</body></html>', tmp_dir / 'second.pdf')
+                ])
+            finally:
+                reset_client()
+        self.assertEqual(stub.requests, 1)
+        self.assertIn('first', PdfReader(tmp_dir / 'first.pdf').pages[0].extract_text())
+        self.assertIn('second', PdfReader(tmp_dir / 'second.pdf').pages[0].extract_text())
+
+    def test_order_generator(self):
+        order = next(OrderGenerator(1, seed=1))
+        self.assertEqual(order, next(OrderGenerator(1, seed=1)))
+        self.assertNotEqual(order, next(OrderGenerator(1, seed=2)))
+        self.assertTrue(CheckItemSerializer(data={'order': order}).is_valid())
+        self.assertEqual(order['total_price'], sum(item['price'] * item['count'] for item in order['items']))
+
+    def test_compare_results(self):
+        result = summarize([i / 1000 for i in range(1, 101)], 1, errors=[ValueError('test')])
+        self.assertEqual(result['count'], 100)
+        self.assertEqual(result['errors'], 1)
+        self.assertEqual(result['throughput'], 100)
+        self.assertEqual((result['p50'], result['p95'], result['max']), (50, 95, 100))
+
+        baseline = {'scenarios': {'ingest': result, 'download': {'p95': None}}}
+        results = {'scenarios': {'ingest': {**result, 'p95': 104.0}, 'download': {'p95': 1.0}}}
+        self.assertEqual(compare_results(baseline, results, threshold=10), [])
+        results['scenarios']['ingest']['p95'] = 110.0
+        self.assertEqual(compare_results(baseline, results, threshold=10), [
+            'ingest: p95 95.0 ms -> 110.0 ms (+15.8%)'
+        ])
@@ -4,7 +4,7 @@ from rest_framework.routers import SimpleRouter
 from rest_framework.schemas import get_schema_view
 
 from checks import views
-from checks.views import download
+from checks.views import download, stream
 
 router = SimpleRouter()
 router.register(r'merchant-points', views.MerchantPointViewSet)
@@ -13,6 +13,7 @@ router.register(r'checks', views.CheckViewSet)
 
 urlpatterns = [
     path('media/<path:path>/', download, name='media'),
+    path('checks/stream/<str:api_key>/', stream, name='check-stream'),
     path('openapi/', get_schema_view(
         title='Checks API',
         description='API microservice for generating checks by orders',
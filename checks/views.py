@@ -1,17 +1,34 @@
+import json
 import logging
+import math
+import mimetypes
+import posixpath
+import re
+import uuid
+from datetime import timedelta
 
+import redis
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
 from django.db.models.deletion import ProtectedError
-from django.http import Http404, FileResponse
+from django.http import Http404, FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date
 from rest_framework import mixins, status
 from rest_framework.decorators import action
-from rest_framework.exceptions import NotFound
+from rest_framework.exceptions import ParseError
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
 from checks import models, serializers
-from checks.tasks import create_checks
+from checks.cache import printer_keys, render_cache
+from checks.dispatch import dispatch_order
+from checks.events import subscribe_printer
+from checks.pagination import ForPrintPagination
+from checks.tasks import BACKFILL_QUEUE, create_checks
 
 log = logging.getLogger(__name__)
 
@@ -90,11 +107,14 @@ class CheckViewSet(CustomModelViewSet):
     retrieve: Returns check
     partial_update: Update check
     delete: Delete check
-    get_for_print: Returns rendered check by printer api key
+    create_batch: Create checks for a list of orders
+    get_for_print: Returns rendered check by printer api key, waits up to `wait` seconds if none
+    claim: Lease up to `limit` rendered checks by printer api key
+    ack: Mark leased checks as printed
     """
     queryset = models.Check.objects.order_by('pk')
     http_method_names = ['get', 'post', 'patch', 'delete']
-    filterset_fields = ['printer', 'check_type', 'status']
+    filterset_fields = ['printer', 'check_type', 'status', 'order_uuid']
 
     def get_serializer_class(self):
         if self.action == 'list':
@@ -108,43 +128,337 @@ class CheckViewSet(CustomModelViewSet):
         serializer.is_valid(raise_exception=True)
         self.perform_create(serializer)
         headers = self.get_success_headers(serializer.data)
-        create_checks.delay(serializer.data['order']['uuid'])
+        dispatch_order(serializer.data['order']['uuid'])
+        data = serializer.data['order']
+        data['checks'] = serializers.CheckListSerializer(serializer.checks, many=True).data
         return Response(
-            data=serializer.data['order'],
+            data=data,
             status=status.HTTP_201_CREATED,
             headers=headers
         )
 
+    @action(
+        methods=['post'],
+        detail=False,
+        url_path='batch',
+        url_name='batch'
+    )
+    def create_batch(self, request):
+        orders = request.data
+        if not isinstance(orders, list) or not orders:
+            raise ParseError('Expected a non-empty list of orders')
+        if len(orders) > settings.CHECKS_BATCH_MAX_SIZE:
+            raise ParseError(f'Batch can not contain more than {settings.CHECKS_BATCH_MAX_SIZE} orders')
+
+        context = self.get_serializer_context()
+        results = []
+        checks = []
+        for index, data in enumerate(orders):
+            serializer = serializers.CheckItemSerializer(data=data, context=context)
+            if not serializer.is_valid():
+                results.append({
+                    'index': index,
+                    'status': status.HTTP_400_BAD_REQUEST,
+                    'errors': serializer.errors
+                })
+                continue
+            order_checks = serializer.build_checks(serializer.validated_data)
+            for check in order_checks:
+                # re-sent by the sweeper to the backfill queue as well
+                check.backfill = True
+            checks.extend(order_checks)
+            results.append({
+                'index': index,
+                'status': status.HTTP_201_CREATED,
+                'order': serializer.validated_data['order'],
+                'checks': order_checks
+            })
+
+        with transaction.atomic():
+            models.Check.objects.bulk_create(checks)
+
+        order_uuids = [
+            (result['order']['uuid'], True) for result in results if 'order' in result
+        ]
+        if order_uuids:
+            # bulk loads go to the backfill queue to keep live orders fast
+            create_checks.chunks(order_uuids, settings.CHECKS_BATCH_CHUNK_SIZE).apply_async(
+                queue=BACKFILL_QUEUE
+            )
+
+        for result in results:
+            if 'checks' in result:
+                result['checks'] = serializers.CheckListSerializer(result['checks'], many=True).data
+        is_created = all(result['status'] == status.HTTP_201_CREATED for result in results)
+        return Response(
+            data={'results': results},
+            status=status.HTTP_201_CREATED if is_created else status.HTTP_207_MULTI_STATUS
+        )
+
     @action(
         methods=['get'],
         detail=False,
         url_path=r'for-print/(?P<api_key>[\w-]+)',
-        url_name='for-print'
+        url_name='for-print',
+        pagination_class=ForPrintPagination
     )
     def get_for_print(self, request, api_key):
+        printer_id = get_printer_id(api_key)
+        queryset = models.Check.objects.filter(
+            printer_id=printer_id, status='rendered'
+        )
+        wait = self.get_wait(request)
+        if wait:
+            try:
+                # Subscribe before the query so a check rendered in between is not missed
+                with subscribe_printer(printer_id) as subscription:
+                    page = self.paginate_queryset(queryset)
+                    if not page and subscription.get(timeout=wait) is not None:
+                        page = self.paginate_queryset(queryset)
+            except redis.RedisError as err:
+                # printers poll without waiting while events are down
+                log.error(err)
+                page = self.paginate_queryset(queryset)
+        else:
+            page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @staticmethod
+    def get_wait(request):
+        """Returns seconds to hold the long-poll request while no check is ready"""
         try:
-            printer = models.Printer.objects.get(api_key=api_key)
-        except (ObjectDoesNotExist, ValidationError) as err:
-            log.error(err)
-            raise NotFound
+            wait = float(request.query_params.get('wait', 0))
+        except ValueError:
+            raise ParseError('wait must be a number of seconds')
+        # nan passes through min and max unclamped
+        if not math.isfinite(wait):
+            raise ParseError('wait must be a number of seconds')
+        return min(max(wait, 0), settings.CHECKS_LONG_POLL_TIMEOUT)
+
+    @action(
+        methods=['post'],
+        detail=False,
+        url_path=r'claim/(?P<api_key>[\w-]+)',
+        url_name='claim'
+    )
+    def claim(self, request, api_key):
+        printer_id = get_printer_id(api_key)
+        serializer = serializers.CheckClaimSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        now = timezone.now()
+        lease_id = uuid.uuid4()
+        leased_until = now + timedelta(seconds=settings.CHECKS_LEASE_TIMEOUT)
+        with transaction.atomic():
+            checks = list(
+                models.Check.objects.select_for_update(skip_locked=True).filter(
+                    Q(leased_until__isnull=True) | Q(leased_until__lte=now),
+                    printer_id=printer_id,
+                    status='rendered'
+                ).order_by('pk')[:serializer.validated_data['limit']]
+            )
+            models.Check.objects.filter(pk__in=[check.pk for check in checks]).update(
+                lease_id=lease_id, leased_until=leased_until
+            )
+        return Response(data={
+            'lease': lease_id,
+            'leased_until': leased_until,
+            'results': serializers.CheckListSerializer(
+                checks, many=True, context=self.get_serializer_context()
+            ).data
+        })
+
+    @action(
+        methods=['post'],
+        detail=False,
+        url_path=r'ack/(?P<api_key>[\w-]+)',
+        url_name='ack'
+    )
+    def ack(self, request, api_key):
+        printer_id = get_printer_id(api_key)
+        serializer = serializers.CheckAckSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
         queryset = models.Check.objects.filter(
-            printer_id=printer.pk, status='rendered'
-        ).order_by('pk')
-        page = self.paginate_queryset(queryset)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+            printer_id=printer_id,
+            status='rendered',
+            lease_id=serializer.validated_data['lease']
+        )
+        if 'ids' in serializer.validated_data:
+            queryset = queryset.filter(pk__in=serializer.validated_data['ids'])
+        printed = queryset.update(
+            status='printed', lease_id=None, leased_until=None, updated_at=timezone.now()
+        )
+        return Response(data={'printed': printed})
+
+
+def get_printer_id(api_key):
+    """Returns id of the printer by api key"""
+    printer_id = printer_keys.resolve(api_key)
+    if printer_id is None:
+        log.info(f'Printer with api key {api_key} not found')
+        raise Http404
+    return printer_id
+
+
+def stream(request, api_key):
+    """
+    Server-sent events stream of checks rendered for the printer.
+    Holds a thread per client, so it is for WSGI, the ASGI application serves async_views.stream
+    """
+    printer_id = get_printer_id(api_key)
+
+    def events():
+        try:
+            with subscribe_printer(printer_id) as subscription:
+                yield ': connected\n\n'
+                while True:
+                    message = subscription.get(timeout=settings.CHECKS_STREAM_KEEPALIVE)
+                    if message is None:
+                        yield ': keepalive\n\n'
+                        continue
+                    event = rendered_event(request, message['id'])
+                    if event is not None:
+                        yield event
+        except redis.RedisError as err:
+            log.error(err)
+            yield error_event('Events are unavailable')
+
+    return event_stream(events())
+
+
+def rendered_event(request, check_id):
+    """Server-sent event of the rendered check, None if it is not rendered anymore"""
+    check = models.Check.objects.filter(pk=check_id, status='rendered').first()
+    if check is None:
+        return None
+    data = serializers.CheckListSerializer(check, context={'request': request}).data
+    return f'id: {check.pk}\nevent: rendered\ndata: {json.dumps(data)}\n\n'
+
+
+def error_event(detail):
+    """Server-sent event of an error closing the stream, clients reconnect after the keepalive interval"""
+    return (
+        f'retry: {settings.CHECKS_STREAM_KEEPALIVE * 1000}\n'
+        f'event: error\ndata: {json.dumps({"detail": detail})}\n\n'
+    )
+
+
+def event_stream(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 
 def download(request, path):
-    file_path = settings.MEDIA_ROOT / path
+    return serve_file(request, path)
+
 
-    if not file_path.exists():
-        log.info(f'File {file_path} not found')
+def serve_file(request, path, read=None):
+    """
+    Response with the stored file supporting conditional and range requests.
+    read yields bytes of (path, start, length), whole files are sent as FileResponse without it
+    """
+    # hidden files are PDFs still being written
+    if posixpath.basename(path).startswith('.') or not default_storage.exists(path):
+        log.info(f'File {path} not found')
         raise Http404
 
-    response = FileResponse(open(file_path, 'rb'))
-    response['Content-Disposition'] = f'inline; filename={file_path.name}'
+    size = default_storage.size(path)
+    modified_at = default_storage.get_modified_time(path).timestamp()
+    digest = render_cache.parse_digest(path)
+    # content-addressed files never change under their name
+    etag = f'"{digest or f"{int(modified_at * 10 ** 6):x}-{size:x}"}"'
+    response = get_conditional_response(request, etag=etag, last_modified=int(modified_at))
+    if response is None:
+        response = send_file(request, path, size, etag, read)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(modified_at)
+    response['Cache-Control'] = (
+        f'public, max-age={settings.CHECKS_DOWNLOAD_MAX_AGE}, immutable' if digest else 'no-cache'
+    )
+    return response
+
+
+def send_file(request, path, size, etag, read=None):
+    """Response with the file or the requested byte range of it, sent by the front proxy if configured"""
+    file_name = posixpath.basename(path)
+    content_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+    accel = get_accel(path)
+    if accel is not None:
+        # the proxy handles ranges itself
+        response = HttpResponse(content_type=content_type)
+        header, value = accel
+        response[header] = value
+    else:
+        byte_range = parse_range(request, size, etag)
+        if byte_range is None and read is None:
+            response = FileResponse(default_storage.open(path), content_type=content_type)
+            response['Content-Length'] = size
+        elif byte_range is None:
+            response = StreamingHttpResponse(read(path, 0, size), content_type=content_type)
+            response['Content-Length'] = size
+        elif byte_range is False:
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = f'bytes */{size}'
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                (read or read_range)(path, start, end - start + 1),
+                status=status.HTTP_206_PARTIAL_CONTENT,
+                content_type=content_type
+            )
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = end - start + 1
+    response['Accept-Ranges'] = 'bytes'
+    # quoted and encoded as FileResponse sets it
+    response['Content-Disposition'] = content_disposition_header(False, file_name)
     return response
+
+
+def get_accel(path):
+    """Returns header and its value for the front proxy to send the file or None to send it by django"""
+    if settings.CHECKS_DOWNLOAD_ACCEL == 'x-accel-redirect':
+        return 'X-Accel-Redirect', f'{settings.CHECKS_DOWNLOAD_ACCEL_PREFIX}{path}'
+    if settings.CHECKS_DOWNLOAD_ACCEL:
+        try:
+            return 'X-Sendfile', default_storage.path(path)
+        except NotImplementedError:
+            # remote storages have no local path for the proxy
+            return None
+    return None
+
+
+def parse_range(request, size, etag):
+    """
+    Returns (start, end) of a single byte range of the request, False if it can't be satisfied
+    or None to send the whole file
+    """
+    header = request.headers.get('Range', '')
+    if_range = request.headers.get('If-Range')
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', header.strip())
+    if not match or not any(match.groups()) or (if_range and if_range != etag):
+        return None
+    start, end = match.groups()
+    if start and end and int(end) < int(start):
+        # invalid range spec, ignored
+        return None
+    if not start:
+        # suffix range with the length of the tail
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size:
+        return False
+    return start, end
+
+
+def read_range(path, start, length, chunk_size=64 * 1024):
+    with default_storage.open(path) as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
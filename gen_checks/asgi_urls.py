@@ -0,0 +1,10 @@
+"""
+URL configuration of the ASGI application, hot endpoints of checks are async views
+"""
+from django.contrib import admin
+from django.urls import path, include
+
+urlpatterns = [
+    path('admin/', admin.site.urls),
+    path('', include('checks.async_urls'))
+]
@@ -54,7 +54,8 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'gen_checks.urls'
+# the ASGI application serves hot endpoints with async views
+ROOT_URLCONF = 'gen_checks.asgi_urls' if os.getenv('CHECKS_ASYNC_VIEWS') else 'gen_checks.urls'
 
 TEMPLATES = [
     {
@@ -82,10 +83,25 @@ WSGI_APPLICATION = 'gen_checks.wsgi.application'
 DATABASES = {
     'default': dj_database_url.config(
         default=os.getenv('DATABASE_URL'),
-        conn_max_age=600
+        # every ASGI request runs in its own thread, persistent connections would pile up
+        conn_max_age=0 if os.getenv('CHECKS_ASYNC_VIEWS') else 600
     )
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHE_URL = os.getenv('CACHE_URL')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CACHE_URL
+    } if CACHE_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -158,6 +174,16 @@ MEDIA_ROOT = BASE_DIR / 'media'
 
 MEDIA_URL = 'media/'
 
+STORAGES = {
+    # checks.storage.LocalStorage or checks.storage.S3Storage
+    'default': {
+        'BACKEND': os.getenv('CHECKS_STORAGE', 'checks.storage.LocalStorage'),
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
 # DRF
 REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
@@ -168,6 +194,118 @@ REST_FRAMEWORK = {
 # celery
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL')
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND')
+# renders are short, so workers take one task at a time and ack it when done
+CELERY_WORKER_PREFETCH_MULTIPLIER = int(os.getenv('CELERY_WORKER_PREFETCH_MULTIPLIER', 1))
+CELERY_TASK_ACKS_LATE = True
+CELERY_TASK_REJECT_ON_WORKER_LOST = True
+# queues of live kitchen and client checks, bulk loads and maintenance,
+# render_check is routed by check type when sent
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+CELERY_TASK_ROUTES = {
+    'checks.tasks.create_checks': {'queue': 'kitchen'},
+    'checks.tasks.create_orders': {'queue': 'kitchen'},
+    'checks.tasks.render_pending': {'queue': 'kitchen'},
+    'checks.tasks.evict_render_cache': {'queue': 'default'},
+    'checks.tasks.archive_printed_checks': {'queue': 'default'},
+    'checks.tasks.sweep_stuck_checks': {'queue': 'default'},
+}
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'queue_order_strategy': 'priority',
+}
+CELERY_BEAT_SCHEDULE = {
+    'evict-render-cache': {
+        'task': 'checks.tasks.evict_render_cache',
+        'schedule': int(os.getenv('CHECKS_RENDER_CACHE_EVICT_INTERVAL', 600))
+    },
+    'archive-printed-checks': {
+        'task': 'checks.tasks.archive_printed_checks',
+        'schedule': int(os.getenv('CHECKS_ARCHIVE_INTERVAL', 24 * 60 * 60))
+    },
+    'sweep-stuck-checks': {
+        'task': 'checks.tasks.sweep_stuck_checks',
+        'schedule': int(os.getenv('CHECKS_SWEEP_INTERVAL', 60))
+    }
+}
 
 # wkhtmltopdf
 WKHTMLTOPDF_URL = os.getenv('WKHTMLTOPDF_URL')
+WKHTMLTOPDF_CONNECT_TIMEOUT = float(os.getenv('WKHTMLTOPDF_CONNECT_TIMEOUT', 3.05))
+WKHTMLTOPDF_READ_TIMEOUT = float(os.getenv('WKHTMLTOPDF_READ_TIMEOUT', 30))
+WKHTMLTOPDF_POOL_SIZE = int(os.getenv('WKHTMLTOPDF_POOL_SIZE', 10))
+WKHTMLTOPDF_RETRIES = int(os.getenv('WKHTMLTOPDF_RETRIES', 2))
+WKHTMLTOPDF_BACKOFF = float(os.getenv('WKHTMLTOPDF_BACKOFF', 0.2))
+WKHTMLTOPDF_BACKOFF_MAX = float(os.getenv('WKHTMLTOPDF_BACKOFF_MAX', 5))
+WKHTMLTOPDF_CIRCUIT_THRESHOLD = int(os.getenv('WKHTMLTOPDF_CIRCUIT_THRESHOLD', 5))
+WKHTMLTOPDF_CIRCUIT_RESET_TIMEOUT = float(os.getenv('WKHTMLTOPDF_CIRCUIT_RESET_TIMEOUT', 30))
+WKHTMLTOPDF_BINARY = os.getenv('WKHTMLTOPDF_BINARY', 'wkhtmltopdf')
+WKHTMLTOPDF_OPTIONS = ['--quiet', '--encoding', 'utf-8']
+
+# checks.renderers.RemoteRenderer, checks.renderers.LocalRenderer,
+# checks.renderers.PooledRenderer or checks.renderers.SimpleRenderer
+CHECKS_RENDERER = os.getenv('CHECKS_RENDERER', 'checks.renderers.RemoteRenderer')
+CHECKS_RENDERER_POOL_SIZE = int(os.getenv('CHECKS_RENDERER_POOL_SIZE', 1))
+CHECKS_RENDERER_MAX_JOBS = int(os.getenv('CHECKS_RENDERER_MAX_JOBS', 500))
+CHECKS_RENDERER_MAX_MEMORY = int(os.getenv('CHECKS_RENDERER_MAX_MEMORY', 256 * 1024 * 1024))
+
+# checks
+# orders committed within the window are sent in one task
+CHECKS_DISPATCH_WINDOW = float(os.getenv('CHECKS_DISPATCH_WINDOW', 0.05))
+CHECKS_DISPATCH_MAX_ORDERS = int(os.getenv('CHECKS_DISPATCH_MAX_ORDERS', 100))
+CHECKS_DISPATCH_RETRIES = int(os.getenv('CHECKS_DISPATCH_RETRIES', 3))
+CHECKS_DISPATCH_RETRY_DELAY = float(os.getenv('CHECKS_DISPATCH_RETRY_DELAY', 1.0))
+CHECKS_BATCH_MAX_SIZE = int(os.getenv('CHECKS_BATCH_MAX_SIZE', 500))
+CHECKS_BATCH_CHUNK_SIZE = int(os.getenv('CHECKS_BATCH_CHUNK_SIZE', 50))
+CHECKS_FOR_PRINT_PAGE_SIZE = int(os.getenv('CHECKS_FOR_PRINT_PAGE_SIZE', 50))
+CHECKS_FOR_PRINT_MAX_PAGE_SIZE = int(os.getenv('CHECKS_FOR_PRINT_MAX_PAGE_SIZE', 500))
+CHECKS_LONG_POLL_TIMEOUT = int(os.getenv('CHECKS_LONG_POLL_TIMEOUT', 25))
+CHECKS_STREAM_KEEPALIVE = int(os.getenv('CHECKS_STREAM_KEEPALIVE', 15))
+CHECKS_CLAIM_LIMIT = int(os.getenv('CHECKS_CLAIM_LIMIT', 10))
+CHECKS_CLAIM_MAX_LIMIT = int(os.getenv('CHECKS_CLAIM_MAX_LIMIT', 100))
+CHECKS_LEASE_TIMEOUT = int(os.getenv('CHECKS_LEASE_TIMEOUT', 60))
+CHECKS_PRINTER_CACHE_SIZE = int(os.getenv('CHECKS_PRINTER_CACHE_SIZE', 4096))
+CHECKS_PRINTER_CACHE_TTL = int(os.getenv('CHECKS_PRINTER_CACHE_TTL', 300))
+CHECKS_PRINTER_CACHE_ALIAS = os.getenv('CHECKS_PRINTER_CACHE_ALIAS', 'default' if CACHE_URL else None)
+# other processes drop a rotated or deleted key from their local cache only when it expires
+CHECKS_PRINTER_CACHE_LOCAL_TTL = int(os.getenv('CHECKS_PRINTER_CACHE_LOCAL_TTL', 5))
+CHECKS_PRINTER_CACHE_NEGATIVE_TTL = int(os.getenv('CHECKS_PRINTER_CACHE_NEGATIVE_TTL', 5))
+# without a shared cache other processes pick up routing changes when their table expires
+CHECKS_ROUTING_CACHE_ALIAS = os.getenv('CHECKS_ROUTING_CACHE_ALIAS', 'default' if CACHE_URL else None)
+CHECKS_ROUTING_CACHE_TTL = int(os.getenv('CHECKS_ROUTING_CACHE_TTL', 300 if CACHE_URL else 5))
+CHECKS_TEMPLATE_VERSION = os.getenv('CHECKS_TEMPLATE_VERSION', '1')
+# hit and miss counters need a cache shared by workers, without one they are not counted
+CHECKS_RENDER_CACHE_ALIAS = os.getenv('CHECKS_RENDER_CACHE_ALIAS', 'default' if CACHE_URL else None)
+CHECKS_RENDER_CACHE_MAX_SIZE = int(os.getenv('CHECKS_RENDER_CACHE_MAX_SIZE', 1024 * 1024 * 1024))
+CHECKS_RETENTION_DAYS = int(os.getenv('CHECKS_RETENTION_DAYS', 30))
+CHECKS_ARCHIVE_BATCH_SIZE = int(os.getenv('CHECKS_ARCHIVE_BATCH_SIZE', 1000))
+CHECKS_ARCHIVE_LOCK_TIMEOUT = int(os.getenv('CHECKS_ARCHIVE_LOCK_TIMEOUT', 60 * 60))
+CHECKS_SWEEP_STUCK_AFTER = int(os.getenv('CHECKS_SWEEP_STUCK_AFTER', 5 * 60))
+CHECKS_SWEEP_BATCH_SIZE = int(os.getenv('CHECKS_SWEEP_BATCH_SIZE', 100))
+CHECKS_SWEEP_MAX_ATTEMPTS = int(os.getenv('CHECKS_SWEEP_MAX_ATTEMPTS', 3))
+CHECKS_SWEEP_LOCK_TIMEOUT = int(os.getenv('CHECKS_SWEEP_LOCK_TIMEOUT', 10 * 60))
+CHECKS_STORAGE_COMPRESS = bool(os.getenv('CHECKS_STORAGE_COMPRESS'))
+CHECKS_S3_BUCKET = os.getenv('CHECKS_S3_BUCKET')
+CHECKS_S3_PREFIX = os.getenv('CHECKS_S3_PREFIX', '')
+CHECKS_S3_ENDPOINT_URL = os.getenv('CHECKS_S3_ENDPOINT_URL')
+CHECKS_DOWNLOAD_MAX_AGE = int(os.getenv('CHECKS_DOWNLOAD_MAX_AGE', 365 * 24 * 60 * 60))
+# x-accel-redirect for nginx or x-sendfile for apache and lighttpd to send files by the proxy,
+# the proxy sends files as stored, so not with compressed storage
+CHECKS_DOWNLOAD_ACCEL = os.getenv('CHECKS_DOWNLOAD_ACCEL')
+CHECKS_DOWNLOAD_ACCEL_PREFIX = os.getenv('CHECKS_DOWNLOAD_ACCEL_PREFIX', '/protected-media/')
+# batches of several orders in one renderer call, 1 renders every check on its own
+CHECKS_RENDER_BATCH_SIZE = int(os.getenv('CHECKS_RENDER_BATCH_SIZE', 1))
+CHECKS_RENDER_BATCH_LINGER = float(os.getenv('CHECKS_RENDER_BATCH_LINGER', 0.2))
+# sent or batched checks are left to their task until the lease runs out, then the sweeper re-sends them.
+# Backfills wait behind bulk loads in their queue, so their leases are longer
+CHECKS_RENDER_LEASE_TIMEOUT = int(os.getenv('CHECKS_RENDER_LEASE_TIMEOUT', 120))
+CHECKS_BACKFILL_LEASE_TIMEOUT = int(os.getenv('CHECKS_BACKFILL_LEASE_TIMEOUT', 60 * 60))
+CHECKS_ESCPOS_WIDTH = int(os.getenv('CHECKS_ESCPOS_WIDTH', 48))
+CHECKS_ESCPOS_ENCODING = os.getenv('CHECKS_ESCPOS_ENCODING', 'cp437')
+CHECKS_ESCPOS_CODEPAGE = int(os.getenv('CHECKS_ESCPOS_CODEPAGE', 0))
+
+# printer events
+CHECKS_EVENTS_URL = os.getenv('CHECKS_EVENTS_URL', CELERY_BROKER_URL)
+CHECKS_EVENTS_BACKEND = os.getenv(
+    'CHECKS_EVENTS_BACKEND',
+    'checks.events.RedisEvents' if CHECKS_EVENTS_URL else 'checks.events.InMemoryEvents'
+)